@@ -0,0 +1,281 @@
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+from datetime import datetime
+import mariadb
+import pandas as pd
+from data import LogTailer, read_log_range, split_log_range, parse_log_timestamps, folder_path
+from db import connection_params, invalidate_cache
+from rollup import run_rollup
+from schema import create_archive_table, create_archive_checkpoint_table
+
+# bytes of a log file parsed and committed per transaction
+window_bytes = 8 * 1024 * 1024
+# rows sent per executemany call
+chunk_rows = 10000
+archive_methods = ["executemany", "load_data"]
+# the dashboard archives log_files/ itself unless HEAL_ARCHIVE=0. Every dashboard process and
+# archive.py --every may run at once, each pass takes a database lock on the folder so only one copies it
+archive_enabled = os.environ.get("HEAL_ARCHIVE", "1") != "0"
+
+insert_archive_rows = """
+INSERT INTO {table} (type, timestamp, module_ID, sub_module_name, line_number, message)
+VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+load_archive_rows = """
+LOAD DATA LOCAL INFILE %s INTO TABLE {table}
+CHARACTER SET utf8mb4
+FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'
+LINES TERMINATED BY '\\n'
+(type, timestamp, module_ID, sub_module_name, line_number, message)
+"""
+
+save_checkpoint = """
+INSERT INTO {table} (file_path, inode, offset, head, updated_at)
+VALUES (%s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE inode = VALUES(inode), offset = VALUES(offset), head = VALUES(head), updated_at = VALUES(updated_at)
+"""
+
+
+# a column as a plain list with None for missing values, iterating pandas string arrays row by row is slow
+def column_values(series):
+    return series.to_numpy(dtype=object, na_value=None).tolist()
+
+
+# parsed log rows as HEAL_archive value tuples, rows with an unreadable timestamp are dropped
+def archive_rows(df):
+    valid = parse_log_timestamps(df["timestamp"]).notna()
+    df = df.loc[valid]
+    columns = [
+        column_values(df["type"].astype(str)),
+        # MariaDB reads fractional seconds after a dot rather than a comma
+        column_values(df["timestamp"].astype(str).str.replace(",", ".", regex=False)),
+        column_values(df["module_id"].astype(str)),
+        column_values(df["sub_module_name"].astype(str)),
+        column_values(pd.to_numeric(df["line_number"], errors="coerce").astype("Int64")),
+        column_values(df["message"].astype("string")),
+    ]
+    return list(zip(*columns)), int((~valid).sum())
+
+
+def insert_executemany(cursor, table, rows, chunk_size=chunk_rows):
+    statement = insert_archive_rows.format(table=table)
+    for start in range(0, len(rows), chunk_size):
+        cursor.executemany(statement, rows[start:start + chunk_size])
+
+
+# write the rows to a tab separated file and bulk load it, the connection needs local_infile
+def insert_load_data(cursor, table, rows):
+    with tempfile.NamedTemporaryFile("w", suffix=".tsv", encoding="utf-8", delete=False) as f:
+        for row in rows:
+            f.write("\t".join(r"\N" if value is None else escape_field(str(value)) for value in row))
+            f.write("\n")
+        path = f.name
+    try:
+        cursor.execute(load_archive_rows.format(table=table), (path,))
+    finally:
+        os.remove(path)
+
+
+def escape_field(value):
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def insert_rows(cursor, table, rows, method="executemany", chunk_size=chunk_rows):
+    if method == "load_data":
+        insert_load_data(cursor, table, rows)
+    else:
+        insert_executemany(cursor, table, rows, chunk_size)
+
+
+# Copies rows appended to log_files/*.csv into HEAL_archive.
+# Every byte window is inserted in one transaction together with the file's new
+# offset in HEAL_archive_checkpoint, so a crash or restart never inserts a line twice
+# and files that are rotated, truncated or rewritten are copied again from the start.
+class ArchiveWriter:
+    def __init__(self, connection, folder_path=folder_path, method="executemany", chunk_size=chunk_rows,
+                 window_size=window_bytes, table="HEAL_archive", checkpoint_table="HEAL_archive_checkpoint"):
+        if method not in archive_methods:
+            raise ValueError(f"unknown archive method {method!r}, expected one of {archive_methods}")
+        self.connection = connection
+        self.method = method
+        self.chunk_size = chunk_size
+        self.window_size = window_size
+        self.table = table
+        self.checkpoint_table = checkpoint_table
+        self.tailer = LogTailer(folder_path)
+        # GET_LOCK names are limited to 64 characters
+        digest = hashlib.sha1(f"{table}:{os.path.abspath(folder_path)}".encode()).hexdigest()[:32]
+        self.lock_name = f"HEAL_archive_{digest}"
+        self.load_checkpoints()
+
+    # resume every file from its committed offset
+    def load_checkpoints(self):
+        cursor = self.connection.cursor()
+        cursor.execute(f"SELECT file_path, inode, offset, head FROM {self.checkpoint_table}")
+        for file_path, inode, offset, head in cursor.fetchall():
+            self.tailer.files[file_path] = {"inode": inode, "offset": offset, "size": 0, "head": bytes(head)}
+        cursor.close()
+
+    def insert(self, cursor, rows):
+        insert_rows(cursor, self.table, rows, self.method, self.chunk_size)
+
+    # copy everything appended since the last call, returns (rows archived, rows skipped, bytes read).
+    # Skips the pass while another archiver holds the folder's lock, it copies the same lines
+    def archive_new_logs(self):
+        archived, skipped, read_bytes = 0, 0, 0
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT GET_LOCK(%s, 0)", (self.lock_name,))
+        if cursor.fetchone()[0] != 1:
+            cursor.close()
+            return archived, skipped, read_bytes
+        try:
+            # another archiver may have moved the checkpoints since this one last held the lock
+            self.load_checkpoints()
+            for log_file, file_start, file_end in self.tailer.scan():
+                state = self.tailer.files[log_file]
+                for start, end in split_log_range(log_file, file_start, file_end, self.window_size):
+                    df, offset = read_log_range(log_file, start, end)
+                    if offset == start:
+                        # only an unfinished last line is left
+                        break
+
+                    rows, bad_rows = archive_rows(df)
+                    if rows:
+                        self.insert(cursor, rows)
+                    cursor.execute(save_checkpoint.format(table=self.checkpoint_table),
+                                   (log_file, state["inode"], offset, state["head"], datetime.now()))
+                    self.connection.commit()
+
+                    state["offset"] = offset
+                    archived += len(rows)
+                    skipped += bad_rows
+                    read_bytes += offset - start
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (self.lock_name,))
+            cursor.fetchone()
+            cursor.close()
+            # queries cached before these rows were committed are stale
+            if archived:
+                invalidate_cache()
+        return archived, skipped, read_bytes
+
+
+def connect(method):
+    return mariadb.connect(local_infile=method == "load_data", **connection_params)
+
+
+# Archives batches of parsed rows that come from no log file, such as the lines sent
+# to the network receiver. There is no file offset to checkpoint, so every batch is
+# committed on its own and a batch that fails is logged and dropped by the caller.
+class BatchArchiver:
+    def __init__(self, method="executemany", chunk_size=chunk_rows, table="HEAL_archive"):
+        if method not in archive_methods:
+            raise ValueError(f"unknown archive method {method!r}, expected one of {archive_methods}")
+        self.method = method
+        self.chunk_size = chunk_size
+        self.table = table
+        self.connection = None
+
+    # archive the rows of one batch, returns (rows archived, rows skipped)
+    def archive(self, df):
+        rows, bad_rows = archive_rows(df)
+        if not rows:
+            return 0, bad_rows
+        if self.connection is None:
+            self.connection = connect(self.method)
+        cursor = self.connection.cursor()
+        try:
+            self.insert(cursor, rows)
+            self.connection.commit()
+            cursor.close()
+            invalidate_cache()
+        except mariadb.Error:
+            # reconnect for the next batch rather than reuse a connection in an unknown state
+            self.close()
+            raise
+        return len(rows), bad_rows
+
+    def insert(self, cursor, rows):
+        insert_rows(cursor, self.table, rows, self.method, self.chunk_size)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except mariadb.Error:
+                pass
+            self.connection = None
+
+
+def report(label, archived, skipped, read_bytes, seconds):
+    seconds = max(seconds, 1e-9)
+    print(f"{label}: archived {archived} rows ({skipped} skipped) from {read_bytes / 1e6:.1f} MB "
+          f"in {seconds:.2f}s, {archived / seconds:,.0f} rows/s, {read_bytes / 1e6 / seconds:.1f} MB/s")
+
+
+# Archive the folder into scratch copies of the tables once per method and report throughput.
+# HEAL_archive and its checkpoints are left untouched.
+def benchmark(folder, methods, chunk_size, window_size):
+    bench_table, bench_checkpoints = "HEAL_archive_bench", "HEAL_archive_bench_checkpoint"
+    for method in methods:
+        connection = connect(method)
+        cursor = connection.cursor()
+        try:
+            cursor.execute(create_archive_table)
+            cursor.execute(create_archive_checkpoint_table)
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {bench_table} LIKE HEAL_archive")
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {bench_checkpoints} LIKE HEAL_archive_checkpoint")
+            cursor.execute(f"TRUNCATE TABLE {bench_table}")
+            cursor.execute(f"TRUNCATE TABLE {bench_checkpoints}")
+
+            started = time.perf_counter()
+            writer = ArchiveWriter(connection, folder, method, chunk_size, window_size, bench_table, bench_checkpoints)
+            archived, skipped, read_bytes = writer.archive_new_logs()
+            report(f"{method} (chunk {chunk_size} rows, window {window_size} bytes)", archived, skipped, read_bytes, time.perf_counter() - started)
+        finally:
+            cursor.execute(f"DROP TABLE IF EXISTS {bench_table}")
+            cursor.execute(f"DROP TABLE IF EXISTS {bench_checkpoints}")
+            cursor.close()
+            connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="copy log_files/*.csv into HEAL_archive")
+    parser.add_argument("--folder", default=folder_path)
+    parser.add_argument("--method", choices=archive_methods, default="executemany")
+    parser.add_argument("--chunk-size", type=int, default=chunk_rows, help="rows per executemany call")
+    parser.add_argument("--window-bytes", type=int, default=window_bytes, help="bytes of a log file committed per transaction")
+    parser.add_argument("--every", type=float, help="keep running, archiving new lines every this many seconds")
+    parser.add_argument("--rollup", action="store_true", help="update the hourly and daily rollups after each pass")
+    parser.add_argument("--benchmark", action="store_true", help="time every method against scratch tables instead")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.folder, archive_methods, args.chunk_size, args.window_bytes)
+        return
+
+    connection = connect(args.method)
+    try:
+        writer = ArchiveWriter(connection, args.folder, args.method, args.chunk_size, args.window_bytes)
+        while True:
+            started = time.perf_counter()
+            archived, skipped, read_bytes = writer.archive_new_logs()
+            report("archive", archived, skipped, read_bytes, time.perf_counter() - started)
+            if args.rollup and archived:
+                print(f"rolled up {run_rollup(connection)} archive rows")
+            if not args.every:
+                break
+            time.sleep(args.every)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
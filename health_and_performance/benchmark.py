@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from data import LogTailer, init_default_dict, update_default_dict, typed_log_frame, parse_workers, service_checks
+from forecast import CapacityForecaster
+from loggen import write_heal_logs, write_perf_logs
+from perf import PerfStats, get_perf_data, perf_column_names
+from render import figure_to_png
+from snapshot import StatusSnapshot
+from util import get_storage_history, get_services_history, service_labels
+from visualisation import graph_width_px, draw_storage_graph, draw_service_status_graph
+
+results_file = "benchmark_results.jsonl"
+default_sizes = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Times each stage and, unless disabled, its peak traced python memory.
+# tracemalloc slows allocation heavy stages down, so timings without it are more faithful.
+class StageTimer:
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name, rows):
+        if self.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            peak = None
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.stages[name] = {
+                "seconds": round(seconds, 4),
+                "rows": rows,
+                "rows_per_s": round(rows / seconds) if seconds > 0 else None,
+                "peak_mb": round(peak / 1e6, 1) if peak is not None else None,
+            }
+            print(f"  {name:<16} {seconds:9.3f}s {self.stages[name]['rows_per_s'] or 0:>12,} rows/s"
+                  + (f" {peak / 1e6:9.1f} MB peak" if peak is not None else ""))
+
+
+# the check_hdd and service rows as the archive queries return them
+def archive_rows(df):
+    timestamps = df["timestamp"].astype("datetime64[ms]").dt.to_pydatetime()
+    checks = df.assign(timestamp=timestamps)
+
+    hdd = checks.loc[checks["sub_module_name"] == "check_hdd"].sort_values("timestamp", kind="stable")
+    storage_rows = list(zip(hdd["timestamp"], hdd["message"].astype(object)))
+
+    services = checks.loc[checks["sub_module_name"].isin(service_checks)]
+    services = services.sort_values(["sub_module_name", "message", "timestamp"], kind="stable")
+    services_rows = list(zip(services["type"].astype(object), services["timestamp"], services["sub_module_name"].astype(object), services["message"].astype(object)))
+    return storage_rows, services_rows
+
+
+# generate logs of the given size into folder and time every stage of the dashboard over them
+def run_benchmark(folder, rows, modules, servers, disks, days, perf_rows, workers, trace_memory):
+    timer = StageTimer(trace_memory)
+    heal_folder, perf_folder = os.path.join(folder, "log_files"), os.path.join(folder, "perf_log_files")
+
+    with timer.stage("generate", rows + perf_rows):
+        write_heal_logs(heal_folder, rows, modules, servers, disks, days)
+        write_perf_logs(perf_folder, perf_rows, modules, days)
+
+    with timer.stage("parse", rows):
+        ranges = LogTailer(heal_folder, parse=typed_log_frame, workers=workers).read_new_ranges()
+        log_files_data = [df for _, _, df, _ in ranges if not df.empty]
+
+    with timer.stage("aggregate", rows):
+        status = init_default_dict(log_files_data)
+        status = update_default_dict(log_files_data, status)
+        StatusSnapshot.from_status(1, status)
+
+    with timer.stage("forecast", rows):
+        forecaster = CapacityForecaster()
+        forecaster.update(log_files_data)
+        forecaster.forecasts()
+
+    storage_rows, services_rows = archive_rows(pd.concat(log_files_data, ignore_index=True))
+    del log_files_data
+
+    with timer.stage("storage_history", len(storage_rows)):
+        storage_data = get_storage_history(storage_rows, sorted(forecaster.trends), graph_width_px)
+
+    with timer.stage("services_history", len(services_rows)):
+        services_data = get_services_history(services_rows)
+
+    with timer.stage("draw_storage", sum(len(history["datetime"]) for history in storage_data.values())):
+        figure_to_png(draw_storage_graph(storage_data))
+
+    with timer.stage("draw_services", sum(len(runs["start"]) for runs in services_data.values())):
+        figure_to_png(draw_service_status_graph(services_data, service_labels(services_data, {})))
+
+    with timer.stage("perf", perf_rows):
+        perf_frames = LogTailer(perf_folder, perf_column_names).read_new_logs()
+        stats = PerfStats()
+        stats.update(get_perf_data(perf_frames))
+        stats.summary()
+
+    return timer.stages
+
+
+# previous result of the same configuration from another commit, to compare against
+def previous_result(path, config, commit):
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["config"] == config and record["commit"] != commit:
+                previous = record
+    return previous
+
+
+def print_comparison(previous, stages):
+    print(f"  compared with {previous['commit']} ({previous['recorded_at']}):")
+    for name, stage in stages.items():
+        before = previous["stages"].get(name)
+        if before and before["seconds"]:
+            print(f"    {name:<16} {stage['seconds'] / before['seconds']:6.2f}x time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time parsing, aggregation and rendering over synthetic logs")
+    parser.add_argument("--rows", type=float, nargs="+", default=default_sizes, help="HEAL row counts to run, e.g. 1e3 1e5 1e7")
+    parser.add_argument("--perf-share", type=float, default=0.1, help="PERF rows as a share of the HEAL rows")
+    parser.add_argument("--modules", type=int, default=10)
+    parser.add_argument("--servers", type=int, default=2)
+    parser.add_argument("--disks", type=int, default=2, help="disks per server")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=parse_workers, help="processes used to parse large backlogs")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc for undisturbed timings")
+    parser.add_argument("--output", default=results_file, help="jsonl file the results are appended to")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    for rows in (int(size) for size in args.rows):
+        config = {
+            "rows": rows,
+            "perf_rows": int(rows * args.perf_share),
+            "modules": args.modules,
+            "servers": args.servers,
+            "disks": args.disks,
+            "days": args.days,
+            "workers": args.workers,
+            "memory": not args.no_memory,
+        }
+        print(f"{rows:,} rows, {args.modules} modules, {args.servers} servers x {args.disks} disks")
+        with tempfile.TemporaryDirectory() as folder:
+            stages = run_benchmark(folder, rows, args.modules, args.servers, args.disks, args.days,
+                                   config["perf_rows"], args.workers, not args.no_memory)
+
+        previous = previous_result(args.output, config, commit)
+        if previous:
+            print_comparison(previous, stages)
+
+        record = {
+            "commit": commit,
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "cpus": os.cpu_count(),
+            "config": config,
+            "stages": stages,
+        }
+        with open(args.output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
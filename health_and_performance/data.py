@@ -1,13 +1,36 @@
+from concurrent.futures import ProcessPoolExecutor
+import io
+import multiprocessing
 import os
 from pathlib import Path
 import re
 import time
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 
 # get log folder path and access its files
 current_dir = Path.cwd()
 folder_path = os.path.join(current_dir, "log_files")
 
+column_names = ["type", "timestamp", "module_id", "sub_module_name", "line_number", "message"]
+
+# a trailing line without a newline is only trusted once the file has been idle this long
+settle_seconds = 2
+# number of leading bytes remembered per file to notice files rewritten in place
+head_bytes = 64
+
+# log timestamps look like 2024-03-04 13:16:23,451, the comma is swapped for a dot
+# before parsing since pandas only has a fast path for the dotted form
+timestamp_format = "%Y-%m-%d %H:%M:%S.%f"
+categorical_columns = ["type", "module_id", "sub_module_name"]
+
+# processes used to parse a large backlog, each gets ranges of about parse_chunk_bytes
+parse_workers = int(os.environ.get("HEAL_PARSE_WORKERS", os.cpu_count() or 1))
+parse_chunk_bytes = 16 * 1024 * 1024
+# smaller backlogs are parsed in this process, starting a pool would cost more than it saves
+parallel_min_bytes = 32 * 1024 * 1024
+
 # Get the file paths of all incoming logs
 def get_new_logs(folder_path):
     files = os.listdir(folder_path)
@@ -15,85 +38,307 @@ def get_new_logs(folder_path):
     return log_files
 
 
-def get_health_data(log_files):
-    log_files_data = []
-    for log_file in log_files:
-        # read each log file into a pandas df for info extraction
-        df = pd.read_csv(log_file, header=None)
-        # Create columns in df for easy id
-        column_names = ["type", "timestamp", "module_id", "sub_module_name", "line_number", "message"]
-        df.columns = column_names
-        log_files_data.append(df)
-    return log_files_data
-
-
-def init_default_dict(log_files_data):
-    dictionary = {
-        "server": {
-            "ip=10.0.0.1": {
-                "status": "INFO"
-            },
-            "ip=10.0.0.2": {
-                "status": "INFO"
-            },
-        }
-    }
-    for log_file in log_files_data:
-        for index, row in log_file.iterrows():
-            if row.module_id not in dictionary:
-                dictionary[row.module_id] = {"status": "INFO"}
-                if row.sub_module_name not in dictionary[row.module_id]:
-                    dictionary[row.module_id][row.sub_module_name] = []
-            else:
-                dictionary[row.module_id][row.sub_module_name]=[]
+# spawned rather than forked, the dashboard process has threads running
+def parse_pool(workers):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+# unreadable timestamps become NaT
+def parse_log_timestamps(timestamps):
+    dotted = timestamps.astype(str).str.replace(",", ".", regex=False)
+    return pd.to_datetime(dotted, format=timestamp_format, errors="coerce")
+
+
+# Repeating columns become categoricals and timestamps like 2024-03-04 13:16:23,451
+# become datetime64. Typed frames are what the parquet cache stores.
+def typed_log_frame(df):
+    df = df.copy()
+    for column in categorical_columns:
+        df[column] = df[column].astype(str).astype("category")
+    df["timestamp"] = parse_log_timestamps(df["timestamp"])
+    df["line_number"] = pd.to_numeric(df["line_number"], errors="coerce").astype("Int32")
+    df["message"] = df["message"].astype("string")
+    return df
+
+
+# read the complete lines between two byte offsets of a log file
+# returns the parsed rows and the offset just after the last line consumed
+def read_log_range(log_file, start, end, names=column_names):
+    with open(log_file, "rb") as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+
+    last_newline = chunk.rfind(b"\n")
+    if last_newline != -1 and last_newline < len(chunk) - 1:
+        # the tail after the last newline may still be being written
+        if time.time() - os.path.getmtime(log_file) < settle_seconds:
+            chunk = chunk[:last_newline + 1]
+    elif last_newline == -1 and time.time() - os.path.getmtime(log_file) < settle_seconds:
+        chunk = b""
+
+    if not chunk.strip():
+        return pd.DataFrame(columns=names), start + len(chunk)
+
+    # a malformed line is dropped rather than failing the range, which would be read again on every poll
+    df = pd.read_csv(io.BytesIO(chunk), header=None, names=names, index_col=False, on_bad_lines="skip")
+    return df, start + len(chunk)
+
+
+# parse a byte range in a pool process, typed frames pickle as compact category codes
+def read_log_chunk(log_file, start, end, names=column_names, parse=None):
+    df, offset = read_log_range(log_file, start, end, names)
+    return (parse(df) if parse is not None else df), offset
+
+
+# split a byte range into consecutive ranges of about size bytes that end after a newline
+def split_log_range(log_file, start, end, size=parse_chunk_bytes):
+    chunks = []
+    with open(log_file, "rb") as f:
+        while end - start > size:
+            f.seek(start + size - 1)
+            f.readline()
+            boundary = min(f.tell(), end)
+            chunks.append((start, boundary))
+            start = boundary
+    if start < end:
+        chunks.append((start, end))
+    return chunks
+
+
+def read_file_head(log_file):
+    with open(log_file, "rb") as f:
+        return f.read(head_bytes)
+
+
+# Follows every csv in a folder and only parses lines appended since the last call.
+# Files are tracked by inode so rotated files (new inode) and truncated or
+# rewritten files (smaller size or different leading bytes) are read from the start again,
+# while a file renamed within the folder carries on from where it was.
+# parse is applied to every parsed range, and with more than one worker a large
+# backlog is split into chunks that are parsed across a process pool.
+class LogTailer:
+    def __init__(self, folder_path, names=column_names, parse=None, workers=1):
+        self.folder_path = folder_path
+        self.names = names
+        self.parse = parse
+        self.workers = workers
+        self.files = {}
+
+    # work out which byte ranges have not been read yet, as (file, start, end)
+    def scan(self):
+        pending = []
+        listing = {}
+        for log_file in sorted(get_new_logs(self.folder_path)):
+            try:
+                listing[log_file] = (os.stat(log_file), read_file_head(log_file))
+            except FileNotFoundError:
+                continue
+        seen = set(listing)
+
+        # tracked files that disappeared, by inode, to pick up renames
+        moved = {state["inode"]: log_file for log_file, state in self.files.items() if log_file not in seen}
+
+        for log_file, (stat, head) in listing.items():
+            state = self.files.get(log_file)
+            if state is None and stat.st_ino in moved:
+                state = self.files.pop(moved.pop(stat.st_ino))
+                self.files[log_file] = state
+
+            if state is not None:
+                rotated = state["inode"] != stat.st_ino
+                truncated = stat.st_size < state["offset"]
+                known = min(len(state["head"]), len(head))
+                rewritten = state["head"][:known] != head[:known]
+                if rotated or truncated or rewritten:
+                    state = None
+
+            if state is None:
+                state = {"inode": stat.st_ino, "offset": 0, "size": 0, "head": head}
+                self.files[log_file] = state
+
+            state["head"] = head
+            state["size"] = stat.st_size
+            if stat.st_size > state["offset"]:
+                pending.append((log_file, state["offset"], stat.st_size))
+
+        # forget files that no longer exist
+        for log_file in list(self.files):
+            if log_file not in seen:
+                del self.files[log_file]
+        return pending
+
+    # parse the newly appended lines of every log file, as (file, start, rows, new offset)
+    def read_new_ranges(self):
+        pending = self.scan()
+        if self.workers > 1 and sum(end - start for _, start, end in pending) >= parallel_min_bytes:
+            ranges = self.read_parallel(pending)
+        else:
+            ranges = [(log_file, start, *read_log_chunk(log_file, start, end, self.names, self.parse))
+                      for log_file, start, end in pending]
+        for log_file, _, _, offset in ranges:
+            self.files[log_file]["offset"] = offset
+        return ranges
+
+    # parse chunks of every pending range across a process pool and stitch each file back together
+    def read_parallel(self, pending):
+        tasks = [(log_file, chunk_start, chunk_end)
+                 for log_file, start, end in pending
+                 for chunk_start, chunk_end in split_log_range(log_file, start, end)]
+        with parse_pool(min(self.workers, len(tasks))) as pool:
+            futures = [pool.submit(read_log_chunk, log_file, start, end, self.names, self.parse) for log_file, start, end in tasks]
+            chunks = {}
+            for (log_file, _, _), future in zip(tasks, futures):
+                chunks.setdefault(log_file, []).append(future.result())
+
+        ranges = []
+        for log_file, start, _ in pending:
+            frames = [df for df, _ in chunks[log_file]]
+            ranges.append((log_file, start, concat_logs(frames), chunks[log_file][-1][1]))
+        return ranges
+
+    # parse only the newly appended lines of every log file
+    def read_new_logs(self):
+        return [df for _, _, df, _ in self.read_new_ranges() if not df.empty]
+
+
+# log levels that never change a module or server status
+quiet_types = ["INFO", "DEBUG"]
+service_checks = ["check_db", "check_rabbit", "check_uvicorn", "check_http", "check_streamlit"]
+
+
+# servers are not configured, update_default_dict adds every server the checks mention
+def init_default_dict(log_files_data, dictionary=None):
+    if dictionary is None:
+        dictionary = {"server": {}}
+    if not log_files_data:
+        return dictionary
+
+    # only the distinct module/sub module pairs need visiting
+    pairs = pd.concat([df[["module_id", "sub_module_name"]] for df in log_files_data]).drop_duplicates()
+    for module_id, sub_module_name in pairs.itertuples(index=False):
+        module = dictionary.setdefault(module_id, {"status": "INFO"})
+        module.setdefault(sub_module_name, [])
     return dictionary
 
 
+# replace the entry for the same disk/server so repeated checks do not pile up
+def upsert_entry(entries, entry):
+    key = next(iter(entry))
+    for index, existing in enumerate(entries):
+        if key in existing:
+            entries[index] = entry
+            return
+    entries.append(entry)
+
+
+# positions of the last row of every distinct code, ordered by where each code first appears
+def last_positions(codes):
+    if len(codes) == 0:
+        return np.array([], dtype=np.intp)
+    _, first = np.unique(codes, return_index=True)
+    _, last_from_end = np.unique(codes[::-1], return_index=True)
+    last = len(codes) - 1 - last_from_end
+    return last[np.argsort(first, kind="stable")]
+
+
+# single integer code for a pair of integer codes
+def combine_codes(major, minor):
+    return major.astype(np.int64) * (int(minor.max(initial=0)) + 1) + minor
+
+
+# split server|hdd|used|available messages into server, disk and storage columns
+# check messages repeat a lot, so only the distinct values are split
+# (columns missing from a batch without any check message are added as object, not float, NaN)
+def split_messages(messages):
+    parts = pd.Series(messages, dtype=object).str.split("|", n=3, expand=True).reindex(columns=range(4)).astype(object)
+    return pd.DataFrame({
+        "server": parts[0],
+        "disk": parts[0] + "|" + parts[1],
+        "storage": parts[2] + "|" + parts[3],
+    })
+
+
+# concatenate log frames, keeping typed columns categorical even when the categories differ
+# (a plain concat would first turn every categorical back into strings)
+def concat_logs(log_files_data):
+    categorical = [column for column in categorical_columns
+                   if all(isinstance(df[column].dtype, pd.CategoricalDtype) for df in log_files_data)]
+    df = pd.concat([df.drop(columns=categorical) for df in log_files_data], ignore_index=True)
+    for column in categorical:
+        df[column] = union_categoricals([frame[column] for frame in log_files_data])
+    return df
+
+
+# Reduces all rows to the latest status per module, sub module, disk and server.
+# Every column is factorized to integer codes once and the reductions run on
+# numpy arrays, so the cost no longer grows with a python loop per row.
+# Produces the same dictionary as applying the rows one by one.
 def update_default_dict(log_files_data, default_dictionary):
+    if not log_files_data:
+        return default_dictionary
 
-    for log_df in log_files_data:
-        for index, row in log_df.iterrows():
-            
-            if row.type not in ["INFO", "DEBUG"]:
-                default_dictionary[row.module_id]["status"] = row.type
-
-            if row.sub_module_name == "check_hdd":
-                server, hdd, used_space, available_space = row.message.split("|")
-                if row.type not in ["INFO", "DEBUG"]:
-                    default_dictionary["server"][server]["status"] = row.type
-                hdd_health = {
-                    f"{server}|{hdd}":{
-                    "status": f"{row.type}",
-                    "storage": f"{used_space}|{available_space}"
-                    }
-                }
-                default_dictionary[row.module_id][row.sub_module_name].append(hdd_health)
-
-            elif row.sub_module_name in ["check_db", "check_rabbit", "check_uvicorn", "check_http", "check_streamlit"]:
-                if row.type not in ["INFO", "DEBUG"]:
-                    default_dictionary["server"][row.message]["status"] = row.type
-                db_health = {
-                    row.message: {
-                        "status": row.type
-                    } 
-                }
-                default_dictionary[row.module_id][row.sub_module_name].append(db_health)
-
-            else:
-                default_dictionary[row.module_id][row.sub_module_name] = {"status": row.type}
-    return default_dictionary
+    df = concat_logs(log_files_data)
+    type_codes, types = pd.factorize(df["type"])
+    module_codes, modules = pd.factorize(df["module_id"])
+    sub_module_codes, sub_modules = pd.factorize(df["sub_module_name"])
+    types, modules, sub_modules = np.asarray(types), np.asarray(modules), np.asarray(sub_modules)
+
+    alert = ~np.isin(types, quiet_types)[type_codes]
+    is_hdd = (sub_modules == "check_hdd")[sub_module_codes]
+    is_service = np.isin(sub_modules, service_checks)[sub_module_codes]
+    is_check = is_hdd | is_service
 
-def check_for_new_logs(folder_path):
-    #while True:
-        log_files = get_new_logs(folder_path)
-        if log_files:
-            log_files_data = get_health_data(log_files)
-            default_dictionary = init_default_dict(log_files_data)
-            current_status = update_default_dict(log_files_data, default_dictionary)
-            return current_status
-        #else:
-        #    print("No new files")
-        #
-        #time.sleep(60) # poll the main folder to check for new logs 
+    # the last warning or error seen for a module sticks as its status
+    alert_rows = np.flatnonzero(alert)
+    for row in alert_rows[last_positions(module_codes[alert_rows])]:
+        module = default_dictionary.setdefault(modules[module_codes[row]], {"status": "INFO"})
+        module["status"] = types[type_codes[row]]
 
+    # split the distinct check messages only and map the fields back by code
+    check_rows = np.flatnonzero(is_check)
+    message_codes, messages = pd.factorize(df["message"].take(check_rows))
+    fields = split_messages(messages)
 
+    # a check without a message, or a check_hdd message without server|hdd, names no service or disk
+    unreadable = np.append(fields["disk"].isna().to_numpy(), True)[message_codes] & is_hdd[check_rows]
+    keep = (message_codes != -1) & ~unreadable
+    check_rows, message_codes = check_rows[keep], message_codes[keep]
+
+    server_codes, servers = pd.factorize(fields["server"])
+    disk_codes, _ = pd.factorize(fields["disk"])
+    for server in servers[np.unique(server_codes[message_codes])]:
+        default_dictionary["server"].setdefault(server, {"status": "INFO"})
+    disks = fields["disk"].to_numpy()
+    storages = fields["storage"].to_numpy()
+    messages = np.asarray(messages)
+
+    # a disk is identified by server|hdd, a service by its whole message
+    check_is_hdd = is_hdd[check_rows]
+    key_codes = np.where(check_is_hdd, disk_codes[message_codes], len(messages) + message_codes)
+
+    alert_checks = np.flatnonzero(alert[check_rows])
+    check_server_codes = server_codes[message_codes[alert_checks]]
+    for position in alert_checks[last_positions(check_server_codes)]:
+        server = servers[server_codes[message_codes[position]]]
+        status = types[type_codes[check_rows[position]]]
+        default_dictionary["server"].setdefault(server, {"status": "INFO"})["status"] = status
+
+    entry_codes = combine_codes(combine_codes(module_codes[check_rows], sub_module_codes[check_rows]), key_codes)
+    for position in last_positions(entry_codes):
+        row = check_rows[position]
+        message_code = message_codes[position]
+        status = types[type_codes[row]]
+        if check_is_hdd[position]:
+            health = {disks[message_code]: {"status": status, "storage": storages[message_code]}}
+        else:
+            health = {messages[message_code]: {"status": status}}
+        upsert_entry(default_dictionary[modules[module_codes[row]]][sub_modules[sub_module_codes[row]]], health)
+
+    # any other sub module simply reports its latest status
+    other_rows = np.flatnonzero(~is_check)
+    pair_codes = combine_codes(module_codes[other_rows], sub_module_codes[other_rows])
+    for row in other_rows[last_positions(pair_codes)]:
+        module_id = modules[module_codes[row]]
+        sub_module_name = sub_modules[sub_module_codes[row]]
+        default_dictionary[module_id][sub_module_name] = {"status": types[type_codes[row]]}
+    return default_dictionary
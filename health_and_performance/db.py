@@ -0,0 +1,292 @@
+import os
+import time
+from datetime import datetime, timedelta, time as dt_time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+import mariadb
+import streamlit as st
+from instrument import timed, record_cache
+
+connection_params = {
+    "host": os.environ.get("HEAL_DB_HOST", "localhost"),
+    "user": os.environ.get("HEAL_DB_USER", "HEAL_history_admin"),
+    "password": os.environ.get("HEAL_DB_PASSWORD", "Jp670525!"),
+    "database": os.environ.get("HEAL_DB_NAME", "HEAL_history"),
+}
+pool_size = 5
+# how long a query waits for a pooled connection when all of them are in use
+pool_wait_seconds = 5
+pool_retry_seconds = 0.05
+
+# query results are reused for this long unless new rows are archived first
+cache_ttl_seconds = 300
+cache_max_entries = 256
+
+# rows shown per page of the module history table
+module_history_page_size = 50
+
+
+# one pool per process, shared by every session instead of a new connection per rerun
+@st.cache_resource
+def get_pool():
+    return mariadb.ConnectionPool(pool_name="HEAL_archive", pool_size=pool_size, **connection_params)
+
+
+# borrow a pooled connection, closing it hands it back to the pool.
+# Sessions share pool_size connections, so a busy pool is waited on rather than failing the panel
+@contextmanager
+def get_connection():
+    deadline = time.monotonic() + pool_wait_seconds
+    while True:
+        try:
+            connection = get_pool().get_connection()
+            break
+        except mariadb.PoolError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(pool_retry_seconds)
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+
+# Least recently used cache of query results with a time to live.
+# Every invalidation bumps the generation so a query that was already running
+# when rows were archived cannot store its now stale result.
+class QueryCache:
+    def __init__(self, max_entries=cache_max_entries, ttl_seconds=cache_ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+
+query_cache = QueryCache()
+
+
+def invalidate_cache():
+    query_cache.invalidate()
+
+
+# bumped whenever cached query results are dropped, so results built from them can be dropped too
+def cache_generation():
+    return query_cache.generation
+
+
+# run a read only query, reusing the cached rows for the same query and parameters
+def fetch_all(query, params=()):
+    key = (query, tuple(params))
+    started = time.perf_counter()
+    rows = query_cache.get(key)
+    if rows is not None:
+        record_cache("db.query_cache", True, (time.perf_counter() - started) * 1000)
+        return rows
+    record_cache("db.query_cache", False, (time.perf_counter() - started) * 1000)
+
+    generation = query_cache.generation
+    with timed("db.query"), get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        rows = tuple(cursor.fetchall())
+        cursor.close()
+    query_cache.put(key, rows, generation)
+    return rows
+
+
+# Date pickers give whole days. Filtering on the raw column with a half open
+# range [start 00:00, day after end 00:00) lets MariaDB range scan the
+# (sub_module_name, timestamp) and (module_ID, timestamp) indexes, which
+# DATE(timestamp) BETWEEN ... prevents.
+def day_range(start_date, end_date):
+    return datetime.combine(start_date, dt_time.min), datetime.combine(end_date + timedelta(days=1), dt_time.min)
+
+
+date_range_query = "SELECT DATE(MIN(timestamp)), DATE(MAX(timestamp)) FROM HEAL_archive"
+storage_history_query = "SELECT timestamp, message FROM HEAL_archive WHERE sub_module_name = %s AND timestamp >= %s AND timestamp < %s ORDER BY timestamp ASC"
+services_history_query = "SELECT type, timestamp, sub_module_name, message FROM HEAL_archive WHERE sub_module_name IN ({placeholders}) AND timestamp >= %s AND timestamp < %s ORDER BY sub_module_name, message, timestamp ASC"
+# One page of a module's history, newest first. Pages continue from the (timestamp, id) of the
+# last row shown rather than an OFFSET, so every page is a short backwards range scan of
+# (module_ID, timestamp), whose entries carry the primary key id as well.
+module_history_query = """
+SELECT id, type, timestamp, module_ID, sub_module_name, message FROM HEAL_archive
+WHERE module_ID = %s AND timestamp >= %s AND timestamp < %s{types}{after}
+ORDER BY timestamp DESC, id DESC LIMIT %s
+"""
+
+# Downsampled variants for long ranges. Rows are grouped into time buckets in SQL so only a
+# bounded number of rows leave the database whatever the range:
+# storage keeps the first and last check of each disk per bucket (ids grow with time),
+# services keep the worst status of each service per bucket.
+bucketed_storage_history_query = """
+SELECT h.timestamp, h.message FROM HEAL_archive h
+JOIN (
+    SELECT MIN(id) AS first_id, MAX(id) AS last_id FROM HEAL_archive
+    WHERE sub_module_name = %s AND timestamp >= %s AND timestamp < %s
+    GROUP BY SUBSTRING_INDEX(message, '|', 2), FLOOR(UNIX_TIMESTAMP(timestamp) / %s)
+) bucket ON h.id IN (bucket.first_id, bucket.last_id)
+ORDER BY h.timestamp ASC
+"""
+bucketed_services_history_query = """
+SELECT ELT(MAX(FIELD(type, 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')), 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL') AS type,
+    MIN(timestamp) AS timestamp, sub_module_name, message
+FROM HEAL_archive
+WHERE sub_module_name IN ({placeholders}) AND timestamp >= %s AND timestamp < %s
+GROUP BY sub_module_name, message, FLOOR(UNIX_TIMESTAMP(timestamp) / %s)
+ORDER BY sub_module_name, message, timestamp ASC
+"""
+
+# Once buckets are an hour or coarser the history is read from the rollups kept by
+# rollup.py instead of raw rows, returning rows of the same shape as the raw queries
+rollup_storage_history_query = "SELECT last_timestamp AS timestamp, last_message AS message FROM HEAL_storage_{granularity} WHERE bucket_start >= %s AND bucket_start < %s ORDER BY last_timestamp ASC"
+rollup_services_history_query = """
+SELECT ELT(worst_level, 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL') AS type, bucket_start AS timestamp, sub_module_name, target AS message
+FROM HEAL_status_{granularity}
+WHERE sub_module_name IN ({placeholders}) AND bucket_start >= %s AND bucket_start < %s
+ORDER BY sub_module_name, target, bucket_start ASC
+"""
+# timestamp of the oldest archive row rollup.py (state heal_rollups) has not read yet, NULL when the rollups are current
+rollup_pending_query = "SELECT MIN(timestamp) FROM HEAL_archive WHERE id > COALESCE((SELECT last_id FROM HEAL_rollup_state WHERE name = 'heal_rollups'), 0)"
+# the rolled up start of a range followed by the raw rows of the part the rollups do not cover yet
+union_history_query = "SELECT * FROM (({rollup}) UNION ALL ({raw})) history ORDER BY {order}"
+
+
+# coarsest rollup that is still no coarser than the requested bucket
+def rollup_granularity(bucket_seconds):
+    if not bucket_seconds or bucket_seconds < 3600:
+        return None
+    return "daily" if bucket_seconds >= 86400 else "hourly"
+
+
+# Where the rollups stop covering [start, end): the start of the bucket holding the oldest
+# row not rolled up yet, start when there is no rollup for the buckets, end when they are current
+def rollup_boundary(granularity, start, end, pending_since=None):
+    if granularity is None:
+        return start
+    if pending_since is None:
+        return end
+    if granularity == "daily":
+        boundary = datetime.combine(pending_since.date(), dt_time.min)
+    else:
+        boundary = pending_since.replace(minute=0, second=0, microsecond=0)
+    return min(max(boundary, start), end)
+
+
+# rollup rows before the boundary and raw rows from it on, ordered as one result
+def history_statement(rollup, raw, boundary, start, end, order):
+    if boundary <= start:
+        return raw
+    if boundary >= end:
+        return rollup
+    return union_history_query.format(rollup=rollup[0], raw=raw[0], order=order), (*rollup[1], *raw[1])
+
+
+def storage_history_statement(start_date, end_date, bucket_seconds=None, pending_since=None):
+    start, end = day_range(start_date, end_date)
+    granularity = rollup_granularity(bucket_seconds)
+    boundary = rollup_boundary(granularity, start, end, pending_since)
+    rollup = (rollup_storage_history_query.format(granularity=granularity), (start, boundary))
+    if bucket_seconds:
+        raw = (bucketed_storage_history_query, ("check_hdd", boundary, end, bucket_seconds))
+    else:
+        raw = (storage_history_query, ("check_hdd", boundary, end))
+    return history_statement(rollup, raw, boundary, start, end, "timestamp ASC")
+
+
+def services_history_statement(services_func, start_date, end_date, bucket_seconds=None, pending_since=None):
+    placeholders = ", ".join(["%s"] * len(services_func))
+    start, end = day_range(start_date, end_date)
+    granularity = rollup_granularity(bucket_seconds)
+    boundary = rollup_boundary(granularity, start, end, pending_since)
+    rollup = (rollup_services_history_query.format(granularity=granularity, placeholders=placeholders), (*services_func, start, boundary))
+    if bucket_seconds:
+        raw = (bucketed_services_history_query.format(placeholders=placeholders), (*services_func, boundary, end, bucket_seconds))
+    else:
+        raw = (services_history_query.format(placeholders=placeholders), (*services_func, boundary, end))
+    return history_statement(rollup, raw, boundary, start, end, "sub_module_name, message, timestamp ASC")
+
+
+# types limits the page to those severities, after is the (timestamp, id) of the previous page's last row.
+# One row more than the page is fetched to tell whether another page follows.
+def module_history_statement(module_name, start_date, end_date, types=None, after=None, page_size=module_history_page_size):
+    params = [module_name, *day_range(start_date, end_date)]
+    types_filter, after_filter = "", ""
+    if types:
+        types_filter = f" AND type IN ({', '.join(['%s'] * len(types))})"
+        params.extend(types)
+    if after is not None:
+        after_timestamp, after_id = after
+        after_filter = " AND (timestamp < %s OR (timestamp = %s AND id < %s))"
+        params.extend([after_timestamp, after_timestamp, after_id])
+    params.append(page_size + 1)
+    return module_history_query.format(types=types_filter, after=after_filter), tuple(params)
+
+
+# every query the dashboard runs as (name, query, params), used by schema.py explain
+def dashboard_queries(start_date, end_date, module_name, services_func, bucket_seconds=None):
+    return [
+        ("date range", date_range_query, ()),
+        ("storage history", *storage_history_statement(start_date, end_date, bucket_seconds)),
+        ("services history", *services_history_statement(services_func, start_date, end_date, bucket_seconds)),
+        ("module history", *module_history_statement(module_name, start_date, end_date)),
+    ]
+
+
+def get_date_range():
+    minmax_dates = fetch_all(date_range_query)
+    earliest_date, latest_date = minmax_dates[0]
+    return earliest_date, latest_date
+
+
+# None when the rollups hold every archived row
+def get_rollup_pending_since():
+    return fetch_all(rollup_pending_query)[0][0]
+
+
+# ranges read from the rollups fall back to raw rows where rollup.py has not caught up
+def get_storage_history_rows(start_date, end_date, bucket_seconds=None):
+    pending_since = get_rollup_pending_since() if rollup_granularity(bucket_seconds) else None
+    return fetch_all(*storage_history_statement(start_date, end_date, bucket_seconds, pending_since))
+
+
+def get_services_history_rows(services_func, start_date, end_date, bucket_seconds=None):
+    pending_since = get_rollup_pending_since() if rollup_granularity(bucket_seconds) else None
+    return fetch_all(*services_history_statement(services_func, start_date, end_date, bucket_seconds, pending_since))
+
+
+# rows of one module history page as (id, type, timestamp, module_ID, sub_module_name, message),
+# and the cursor of the next page or None on the last one
+def get_module_history_page(module_name, start_date, end_date, types=None, after=None, page_size=module_history_page_size):
+    rows = fetch_all(*module_history_statement(module_name, start_date, end_date, types, after, page_size))
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    return rows, (rows[-1][2], rows[-1][0])
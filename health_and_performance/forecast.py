@@ -0,0 +1,170 @@
+import math
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from util import parse_hdd_messages
+
+full_storage = 100.0
+seconds_per_day = 86400
+# recent checks count more, a check this old weighs half as much as a new one
+half_life_seconds = 7 * seconds_per_day
+# two sided 95% interval on the fill rate
+confidence_z = 1.96
+# dates further out than this are reported as not filling up
+horizon_days = 10 * 365
+# with a window, checks drop out of it in this many time buckets per window length
+window_buckets = 24
+
+# full_at, earliest and latest are None when the disk is not filling up within the horizon,
+# gradient is in % per day and delta is the change between the last two checks
+Forecast = namedtuple("Forecast", ["full_at", "earliest", "latest", "gradient", "used_pct", "delta", "points"])
+
+# weighted sums kept per disk: Σw, Σwx, Σwy, Σwx², Σwxy, Σwy², Σw²
+sum_names = ["w", "x", "y", "xx", "xy", "yy", "ww"]
+
+
+def weighted_sums(x, y, weights):
+    return np.array([
+        weights.sum(),
+        (weights * x).sum(),
+        (weights * y).sum(),
+        (weights * x * x).sum(),
+        (weights * x * y).sum(),
+        (weights * y * y).sum(),
+        (weights * weights).sum(),
+    ])
+
+
+# Least squares line of used % against time for one disk, kept as running sums so a
+# batch of new checks costs O(batch) and a forecast O(1) whatever the history length.
+# x is days since the first check. With half_life_seconds the sums decay exponentially,
+# with window_seconds the sums are also kept per time bucket of window_seconds / window_buckets,
+# and a bucket drops out once it has left the window, however the checks were batched.
+class DiskTrend:
+    def __init__(self, half_life_seconds=None, window_seconds=None):
+        if half_life_seconds and window_seconds:
+            raise ValueError("use either half_life_seconds or window_seconds, not both")
+        self.half_life_seconds = half_life_seconds
+        self.window_seconds = window_seconds
+        self.origin = None
+        self.reference = None
+        self.sums = np.zeros(len(sum_names))
+        # bucket index: (sums, checks) of the checks in that bucket, only with window_seconds
+        self.buckets = {}
+        self.points = 0
+        # (seconds, used %) of the newest two checks
+        self.last = []
+
+    # seconds since the epoch and used % of new checks, in any order
+    def update(self, seconds, used_pct):
+        if len(seconds) == 0:
+            return
+        if self.origin is None:
+            self.origin = float(seconds.min())
+        reference = max(float(seconds.max()), self.reference if self.reference is not None else -math.inf)
+        x = (seconds - self.origin) / seconds_per_day
+
+        weights = np.ones(len(x))
+        if self.half_life_seconds:
+            if self.reference is not None:
+                decay = 0.5 ** ((reference - self.reference) / self.half_life_seconds)
+                # every weight is scaled by decay, so Σw² is scaled by its square
+                self.sums *= np.where(np.array(sum_names) == "ww", decay * decay, decay)
+            weights = 0.5 ** ((reference - seconds) / self.half_life_seconds)
+        batch = weighted_sums(x, used_pct, weights)
+        self.sums += batch
+        self.reference = reference
+        self.points += len(x)
+
+        if self.window_seconds:
+            bucket_seconds = self.window_seconds / window_buckets
+            indices = np.floor(seconds / bucket_seconds).astype(np.int64)
+            for index in np.unique(indices).tolist():
+                in_bucket = indices == index
+                sums, count = self.buckets.get(index, (0.0, 0))
+                self.buckets[index] = (sums + weighted_sums(x[in_bucket], used_pct[in_bucket], weights[in_bucket]), count + int(in_bucket.sum()))
+            for index in sorted(self.buckets):
+                if (index + 1) * bucket_seconds >= reference - self.window_seconds:
+                    break
+                expired, count = self.buckets.pop(index)
+                self.sums -= expired
+                self.points -= count
+
+        newest = np.argsort(seconds, kind="stable")[-2:]
+        self.last = sorted(self.last + [(float(seconds[i]), float(used_pct[i])) for i in newest])[-2:]
+
+    def to_datetime(self, x):
+        if not math.isfinite(x) or x - (self.reference - self.origin) / seconds_per_day > horizon_days:
+            return None
+        return pd.Timestamp(round((self.origin + x * seconds_per_day) * 1000), unit="ms").to_pydatetime()
+
+    def forecast(self):
+        if not self.last:
+            return None
+        used_pct = self.last[-1][1]
+        delta = round(self.last[-1][1] - self.last[0][1], 2) if len(self.last) == 2 else 0.0
+        w, sx, sy, sxx, sxy, syy, ww = self.sums
+        if self.points < 2 or w <= 0:
+            return Forecast(None, None, None, math.nan, used_pct, delta, self.points)
+        mean_x, mean_y = sx / w, sy / w
+        var_x = sxx - w * mean_x * mean_x
+        if var_x <= 1e-12 * max(1.0, sxx):
+            return Forecast(None, None, None, math.nan, used_pct, delta, self.points)
+
+        gradient = (sxy - w * mean_x * mean_y) / var_x
+        # standard error of the gradient, using the effective number of checks for weighted sums
+        effective_n = w * w / ww
+        residual = max(syy - w * mean_y * mean_y - gradient * (sxy - w * mean_x * mean_y), 0.0)
+
+        def full_date(rate):
+            if used_pct >= full_storage:
+                return self.to_datetime((self.reference - self.origin) / seconds_per_day)
+            if rate <= 0:
+                return None
+            return self.to_datetime(mean_x + (full_storage - mean_y) / rate)
+
+        # no bounds until there are enough checks to estimate the spread
+        earliest, latest = None, None
+        if effective_n > 2:
+            variance = residual / w * effective_n / (effective_n - 2)
+            error = math.sqrt(variance / (var_x / w * effective_n))
+            earliest, latest = full_date(gradient + confidence_z * error), full_date(gradient - confidence_z * error)
+
+        return Forecast(
+            full_date(gradient),
+            earliest,
+            latest,
+            float(gradient),
+            used_pct,
+            delta,
+            self.points,
+        )
+
+
+# One DiskTrend per server|hdd disk, fed with the check_hdd rows as they are parsed
+class CapacityForecaster:
+    def __init__(self, half_life_seconds=half_life_seconds, window_seconds=None):
+        self.half_life_seconds = half_life_seconds
+        self.window_seconds = window_seconds
+        self.trends = {}
+
+    # log frames with datetime64 timestamps, only check_hdd rows are used
+    def update(self, log_files_data):
+        frames = [df.loc[df["sub_module_name"] == "check_hdd", ["timestamp", "message"]] for df in log_files_data]
+        checks = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if checks.empty:
+            return
+        checks = checks.loc[checks["timestamp"].notna()]
+        parsed = parse_hdd_messages(checks["message"].astype(object))
+        disks = parsed["server"] + "|" + parsed["partition"]
+        valid = parsed["used_pct"].notna() & disks.notna()
+        seconds = checks["timestamp"].astype("datetime64[ms]").astype("int64").to_numpy() / 1000
+        used_pct = parsed["used_pct"].to_numpy(dtype=float)
+        for disk, rows in pd.Series(np.flatnonzero(valid.to_numpy())).groupby(disks[valid].to_numpy(), sort=False):
+            trend = self.trends.get(disk)
+            if trend is None:
+                trend = self.trends[disk] = DiskTrend(self.half_life_seconds, self.window_seconds)
+            trend.update(seconds[rows.to_numpy()], used_pct[rows.to_numpy()])
+
+    def forecasts(self):
+        return {disk: trend.forecast() for disk, trend in self.trends.items()}
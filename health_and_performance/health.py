@@ -1,175 +1,297 @@
 import streamlit as st
 import pandas as pd
-import mariadb
 import numpy as np
 from matplotlib import pyplot as plt
 from datetime import datetime, timedelta
 import time
-from threading import Thread
-from data import check_for_new_logs, folder_path
-from util import selected_hdd, get_date_range, get_hdd_storage, get_services_status, get_module_status, get_storage_history, get_services_history, get_service_func
-from visualisation import draw_donut_chart, status_indicator, create_module, draw_storage_graph, draw_service_status_graph, style_df, highlight_errors
+from worker import get_status_worker, get_perf_worker, get_receiver
+from render import render_png
+from instrument import RerunProfiler, enable_samples
+from perf import format_latency, get_perf_apps, get_app_latencies, get_latency_percentiles, quantiles, window_size
+from rollup import status_levels
+from db import cache_generation, day_range, get_date_range, get_storage_history_rows, get_services_history_rows, get_module_history_page
+from util import selected_hdd, history_bucket_seconds, get_hdd_storage, get_services_status, get_module_status, get_storage_history, get_services_history, service_labels
+from visualisation import graph_width_px, draw_storage_gauge, status_indicator, create_module, draw_storage_graph, draw_service_status_graph, style_df, highlight_errors
 
 st.set_page_config(page_title="Health Dashboard", layout="wide")
 
+# every rerun is timed, ?profile=1 also profiles this one rerun with cProfile and tracemalloc
+enable_samples()
+profiler = RerunProfiler(profile="profile" in st.query_params)
+profiler.start()
+
 with open("style.css", "r") as f:
     css = f.read()
 st.markdown(f"<style>{css}</style>", unsafe_allow_html=True)
 
-current_status = check_for_new_logs(folder_path)
-
-connection = mariadb.connect(host="localhost", user="HEAL_history_admin", password="Jp670525!", database="HEAL_history")
-
-# limit date input options to available data
-earliest_date, latest_date = get_date_range(connection)
-
-server_col, service_col, module_col = st.columns([30, 35, 35])
-
-with server_col:
-    overview_container = st.container(border=True)
-    storage_container = st.container(border=True)
-    extrapolation_container = st.container(border=True)
-
-    servers = ["ip=10.0.0.1", "ip=10.0.0.2"]
-    partitions = ["/dev/sda", "/dev/sdb"]
-
-    # overview of server status and hard disk storage
-    with overview_container:
-        servercols = st.columns(len(servers))
-        for index, server in enumerate(servers):
+# Each panel is a fragment: a widget change reruns only its own panel, and every
+# refresh_seconds each panel reruns on its own to show new data. The workers are
+# woken by file changes, so a refresh shows lines that arrived moments before.
+refresh_seconds = 5
+
+status_worker = get_status_worker()
+perf_worker = get_perf_worker()
+# listens for agents when HEAL_RECEIVER_PORT is set
+get_receiver()
+
+
+# p95 latency of each function over the latest hour, with the change from the hour before as the delta
+def show_latency_metrics(cols, latencies):
+    if not latencies:
+        cols[0].caption("No performance records")
+    for index, (function, stats) in enumerate(latencies.items()):
+        delta = stats["p95_ms"] - stats["previous_p95_ms"]
+        cols[index % len(cols)].metric(
+            f"{function} p95",
+            value=format_latency(stats["p95_ms"]),
+            delta=None if np.isnan(delta) else f"{delta:+.3g}ms",
+            delta_color="inverse",
+            help=(
+                f"p50 {format_latency(stats['p50_ms'])}, p99 {format_latency(stats['p99_ms'])}, "
+                f"last {format_latency(stats['last_ms'])}, mean of last {min(stats['count'], window_size)}: {format_latency(stats['mean_ms'])}"
+            ),
+        )
+
+
+# Value of compute() kept in the session under name until key changes. Keys hold a
+# panel's inputs and the version of the data behind them, so a timed refresh with
+# nothing new neither queries nor redraws.
+def panel_value(name, key, compute):
+    cached = st.session_state.get(name)
+    if cached is None or cached[0] != key:
+        cached = (key, compute())
+        st.session_state[name] = cached
+    return cached[1]
+
+
+# Cursors of the module history pages visited so far, the last one is the page shown.
+# They start over whenever the module, dates or severities change.
+def module_history_cursors(key):
+    if st.session_state.get("module_history_key") != key:
+        st.session_state["module_history_key"] = key
+        st.session_state["module_history_cursors"] = [None]
+    return st.session_state["module_history_cursors"]
+
+
+def next_module_history_page(cursor):
+    st.session_state["module_history_cursors"].append(cursor)
+
+
+def previous_module_history_page():
+    st.session_state["module_history_cursors"].pop()
+
+
+# servers and disks are whatever the checks report, laid out in rows of these many
+servers_per_row = 4
+disks_per_row = 4
+
+
+# html of every server's status and (partition, server, gauge html) of every disk
+def server_overview_content(status_snapshot):
+    servers = [f"{server}: {status_indicator(status_snapshot.get_server_status(server))}" for server in sorted(status_snapshot.servers)]
+    hdds_storage = get_hdd_storage(status_snapshot)
+    disks = []
+    for disk in sorted(hdds_storage):
+        server, partition = disk.split("|", 1)
+        used_storage, remaining_storage = hdds_storage[disk]
+        disks.append((partition, server, draw_storage_gauge(used_storage, remaining_storage)))
+    return servers, disks
+
+
+# overview of server status and hard disk storage
+@st.fragment(run_every=refresh_seconds)
+def server_overview():
+    status_snapshot = status_worker.snapshot()
+    servers, disks = panel_value("server_overview", status_snapshot.version, lambda: server_overview_content(status_snapshot))
+    if not servers:
+        st.caption("No server has reported yet")
+
+    for row_start in range(0, len(servers), servers_per_row):
+        servercols = st.columns(servers_per_row)
+        for index, server_html in enumerate(servers[row_start:row_start + servers_per_row]):
             with servercols[index]:
-                status = current_status["server"][server]["status"]
-                server = st.container(border=True)
-                server.write(f"Server {index+1}: {status_indicator(status)}", unsafe_allow_html=True)
-        
-        cols = st.columns(len(servers) * len(partitions))
-        hdds_storage = get_hdd_storage(current_status)
-        for i, server in enumerate(servers):
-            for j, partition in enumerate(partitions):
-
-                col_index = i * len(partitions) + j
-
-                with cols[col_index]:
-                    with st.container(border=True):      
-                        used_storage, remaining_storage = hdds_storage[col_index]
-                        fig = draw_donut_chart(used_storage, remaining_storage)
-                        st.write(partition)
-                        st.pyplot(fig, use_container_width=True)
-                                      
-                        
-    # Graph of hard disk storage against time
-    with storage_container:
-        server_options = ["All", "Server 1", "Server 2"]
-        partition_options = ["All", "/dev/sda", "/dev/sdb"]
+                server_container = st.container(border=True)
+                server_container.write(server_html, unsafe_allow_html=True)
 
+    for row_start in range(0, len(disks), disks_per_row):
+        cols = st.columns(disks_per_row)
+        for index, (partition, server, gauge_html) in enumerate(disks[row_start:row_start + disks_per_row]):
+            with cols[index]:
+                with st.container(border=True):
+                    st.write(partition)
+                    st.caption(server)
+                    st.markdown(gauge_html, unsafe_allow_html=True)
+
+
+# (disk, full date, delta, help) of the selected disks that have a forecast
+def forecast_metrics(disk_forecasts, selected_hdds):
+    metrics = []
+    for hdd in selected_hdds:
+        forecast = disk_forecasts.get(hdd)
+        if forecast is None:
+            continue
+        # a rate needs at least two checks taken at different times
+        if forecast.points < 2 or np.isnan(forecast.gradient):
+            formated_date = "Not enough data"
+        elif forecast.full_at:
+            formated_date = forecast.full_at.strftime("%d %B %Y")
+        else:
+            formated_date = "Not filling up"
+        delta = str(forecast.delta) + "%"
+        if forecast.earliest and forecast.latest:
+            help_text = f"95% range {forecast.earliest:%d %B %Y} to {forecast.latest:%d %B %Y}"
+        elif forecast.earliest:
+            help_text = f"95% range from {forecast.earliest:%d %B %Y}, possibly never"
+        else:
+            help_text = None
+        metrics.append((hdd, formated_date, delta, help_text))
+    return metrics
+
+
+# Graph of hard disk storage against time, and the dates the shown disks fill up
+@st.fragment(run_every=refresh_seconds)
+def storage_history():
+    # limit date input options to available data
+    earliest_date, latest_date = get_date_range()
+    status_snapshot = status_worker.snapshot()
+    server_options = ("All",) + tuple(sorted(status_snapshot.servers))
+    partition_options = ("All",) + status_snapshot.partitions()
+
+    with st.container(border=True):
         cols = st.columns(4)
         server = cols[0].selectbox("Servers", options = server_options)
         partition = cols[1].selectbox("Partitions", options = partition_options)
         start_date = cols[2].date_input("From:", format="YYYY/MM/DD", key="server_from",value=earliest_date, min_value=earliest_date, max_value=latest_date)
         end_date = cols[3].date_input("To:", format="YYYY/MM/DD", key="server_to",value=latest_date, min_value=earliest_date, max_value=latest_date)
-        
-        # Get hard disk storage history from database for plotting 
-        cursor = connection.cursor()
-        cursor.execute("SELECT timestamp, message FROM HEAL_archive WHERE sub_module_name = %s AND DATE(timestamp) BETWEEN %s AND %s ORDER BY timestamp ASC", ("check_hdd", start_date, end_date))
-        all_storage_history = cursor.fetchall()
-        cursor.close()
-
-        # Graph user selected data
-        selected_hdds = selected_hdd(server, partition, server_options, partition_options) 
-        storage_history_data = get_storage_history(all_storage_history, selected_hdds)
-        storage_graph, full_storage_dates = draw_storage_graph(storage_history_data)
-        st.pyplot(storage_graph)
-
-    # Linear regression to extrapolate estimated full hardisk capacity based on current usage
-    with extrapolation_container:
+        selected_hdds = selected_hdd(server, partition, server_options, partition_options)
+
+        # Get hard disk storage history from database for plotting
+        # long ranges are bucketed in the database so the rows fetched stay within the graph's width
+        def draw():
+            bucket_seconds = history_bucket_seconds(start_date, end_date, graph_width_px)
+            all_storage_history = get_storage_history_rows(start_date, end_date, bucket_seconds)
+            storage_history_data = get_storage_history(all_storage_history, selected_hdds, graph_width_px)
+            return render_png(draw_storage_graph, storage_history_data)[0]
+
+        st.image(panel_value("storage_graph", (selected_hdds, start_date, end_date, cache_generation()), draw))
+
+    # Linear regression to extrapolate estimated full hardisk capacity based on current usage,
+    # kept up to date by the status worker as checks arrive
+    with st.container(border=True):
         st.write("Anticipated full disk capacity dates @ current usage:")
-        cols = st.columns(len(full_storage_dates))
-        for index, (hdd, storage_metric) in enumerate(full_storage_dates.items()):
-            date = storage_metric["date"]
-            delta = str(storage_metric["storage_delta"]) + "%"
-            formated_date = date.strftime("%d %B %Y")
+        hdd_forecasts = panel_value("disk_forecasts", (selected_hdds, status_snapshot.version), lambda: forecast_metrics(status_worker.forecasts, selected_hdds))
+        cols = st.columns(max(len(hdd_forecasts), 1))
+        for index, (hdd, formated_date, delta, help_text) in enumerate(hdd_forecasts):
             with cols[index]:
                 metric_container = st.container(border=True)
-                metric_container.metric(hdd, formated_date, delta)
+                metric_container.metric(hdd, formated_date, delta, help=help_text)
+
+
+service_names = {"check_rabbit": "rabbitMQ", "check_db": "MariaDB", "check_uvicorn": "Uvicorn", "check_http": "HTTP", "check_streamlit": "Streamlit"}
+services_func = tuple(service_names)
+icons = ["rabbitmq", "mariadb", "uvicorn", "http", "streamlit"]
+
+
+# (icon, status html, server) of every service check
+def service_checks_content(status_snapshot):
+    checks = []
+    for service, icon in zip(services_func, icons):
+        for info in get_services_status(status_snapshot, service):
+            checks.append((icon, f"Status: {status_indicator(info.status)}", info.key))
+    return checks
 
-with service_col:
 
-    services = ["MariaDB 1", "MariaDB 2", "HTTP", "rabbitMQ", "Streamlit", "Uvicorn"]
-    services_func = ("check_rabbit", "check_db", "check_uvicorn", "check_http", "check_streamlit")
-    icons = ["rabbitmq", "mariadb", "uvicorn", "http", "streamlit"]
-            
+# current service checks, their history and the response times of the apps
+@st.fragment(run_every=refresh_seconds)
+def service_status():
+    status_snapshot = status_worker.snapshot()
+    earliest_date, latest_date = get_date_range()
+
     service_overview_container = st.container(border=True)
     with service_overview_container:
-    
-        cols = st.columns(6)
-        index = 0
-        for service, icon in list(zip(services_func, icons)):
-            sub_module_info = get_services_status(current_status, service)
 
-            for info in sub_module_info:
-                status = list(info.values())[0]["status"]
-                with cols[index]:
-                    service_container = st.container()
-                    service_container.image(f"./icons/{icon}.png")
-                    service_container.write(f"Status: {status_indicator(status)}", unsafe_allow_html=True)
-                index+=1
+        cols = st.columns(6)
+        checks = panel_value("service_overview", status_snapshot.version, lambda: service_checks_content(status_snapshot))
+        # one check per server, wrapping onto further rows
+        for index, (icon, status_html, server) in enumerate(checks):
+            with cols[index % len(cols)]:
+                service_container = st.container()
+                service_container.image(f"./icons/{icon}.png")
+                service_container.write(status_html, unsafe_allow_html=True)
+                service_container.caption(server)
 
     service_status_container = st.container(border=True)
     with service_status_container:
 
         cols = st.columns([60, 20, 20])
-        selected_services = cols[0].multiselect("Select services", options=services, default=services)
         start_date = cols[1].date_input("From:", format="DD/MM/YYYY", key="service_from", value=earliest_date, min_value=earliest_date, max_value=latest_date)
         end_date = cols[2].date_input("To:", format="DD/MM/YYYY", key="service_to", value=latest_date, min_value=earliest_date, max_value=latest_date)
-        
-        # fetch status history from DB
-        cursor = connection.cursor()
-        cursor.execute("SELECT type, timestamp, sub_module_name, message FROM HEAL_archive WHERE sub_module_name in (%s, %s, %s, %s, %s) AND DATE(timestamp) BETWEEN %s AND %s ORDER BY sub_module_name, message, timestamp ASC", (*services_func, earliest_date, latest_date))
-        services_status_history = cursor.fetchall()
-        cursor.close()
-
-        # process data and plot graph
-        data = get_services_history(services_status_history)
-        service_name_w_func = list(zip(services, list(data.keys())))
-        selected_service_func = get_service_func(selected_services, service_name_w_func)
-        fig = draw_service_status_graph(data, selected_service_func)
-        st.pyplot(fig)
+
+        # fetch status history from DB, one row per service and server checked in these dates
+        def history():
+            bucket_seconds = history_bucket_seconds(start_date, end_date, graph_width_px)
+            services_status_history = get_services_history_rows(services_func, start_date, end_date, bucket_seconds)
+            data = get_services_history(services_status_history)
+            return data, service_labels(data, service_names)
+
+        data, labels = panel_value("service_status_history", (start_date, end_date, cache_generation()), history)
+        selected_services = cols[0].multiselect("Select services", options=list(labels), default=list(labels), format_func=labels.get)
+
+        def draw():
+            return render_png(draw_service_status_graph, data, {key: labels[key] for key in selected_services})[0]
+
+        st.image(panel_value("service_status_graph", (tuple(selected_services), start_date, end_date, cache_generation()), draw))
 
     service_perf_container = st.container(border=True)
     with service_perf_container:
+        perf_snapshot = perf_worker.snapshot()
+        perf_latencies = perf_snapshot.latencies
         cols = st.columns(2)
+        perf_apps = panel_value("perf_apps", perf_snapshot.version, lambda: get_perf_apps(perf_latencies))
+
         cols[0].write("Services response time")
-        cols[0].selectbox("Select App", options=["SR01", "ET01"])
-        cols[0].metric("DB Latency", value="0.002ms", delta="0.0032")
-        cols[0].metric("Queue Latency", value="0.102ms", delta="0.0057")
+        app = cols[0].selectbox("Select App", options=perf_apps, key="services_perf_app")
+        show_latency_metrics([cols[0]], get_app_latencies(perf_latencies, app))
 
         cols[1].write("API response time")
-        cols[1].selectbox("Select App", options=["ET01", "VN01"])
-        cols[1].metric("dbip Latency", value="0.002ms", delta="0.0032")
-        cols[1].metric("mt Latency", value="0.102ms", delta="0.0057")
-        cols[1].metric("kc Latency", value="0.102ms", delta="0.0057")
+        app = cols[1].selectbox("Select App", options=perf_apps, index=min(1, max(len(perf_apps) - 1, 0)), key="api_perf_app")
+        show_latency_metrics([cols[1]], get_app_latencies(perf_latencies, app))
+
 
-modules = []
 modules_per_row = 9
 
-with module_col:
+
+# (module name without its prefix, card html) of every module
+def module_cards_content(status_snapshot):
+    cards = []
+    for module in get_module_status(status_snapshot):
+        (module_name, status), = module.items()
+        module_name_no_prefix = module_name.split("_")[1]
+        cards.append((module_name_no_prefix, create_module(module_name_no_prefix, status)))
+    return cards
+
+
+# module statuses and the history of the selected module
+@st.fragment(run_every=refresh_seconds)
+def module_table():
+    status_snapshot = status_worker.snapshot()
+    earliest_date, latest_date = get_date_range()
+    modules = []
+
     module_overview = st.container(border=True)
-    with module_overview:   
+    with module_overview:
         st.write("Modules")
-        module_status_list = get_module_status(current_status)
+        module_cards = panel_value("module_overview", status_snapshot.version, lambda: module_cards_content(status_snapshot))
 
         # separate the list of modules to be displayed into rows
-        sublists = [module_status_list[i:i+modules_per_row] for i in range(0, len(module_status_list), modules_per_row)]
+        sublists = [module_cards[i:i+modules_per_row] for i in range(0, len(module_cards), modules_per_row)]
         for sublist in sublists:
             cols = st.columns(modules_per_row)
-            for index, module in enumerate(sublist):
-                module_name = list(module.keys())
-                module_name_no_prefix = module_name[0].split("_")[1]
+            for index, (module_name_no_prefix, module_html) in enumerate(sublist):
                 modules.append(module_name_no_prefix)
-                status = list(module.values())
                 with cols[index]:
                     module_container = cols[index].container(border=False)
-                    module_container.write(create_module(module_name_no_prefix, status[0]), unsafe_allow_html=True)
+                    module_container.write(module_html, unsafe_allow_html=True)
 
 
     module_info = st.container(border=True)
@@ -180,36 +302,55 @@ with module_col:
         start_date = cols[2].date_input("From:", format="YYYY/MM/DD", key="module_from", value=earliest_date, min_value=earliest_date, max_value=latest_date)
         end_date = cols[3].date_input("To:", format="YYYY/MM/DD", key="module_to", value=latest_date, min_value=earliest_date, max_value=latest_date)
 
-        # query user selected module history by date range 
+        types = cols[1].multiselect("Severity", options=status_levels, placeholder="All")
+
+        # query one page of the user selected module history by date range
         module_name = f"HEAL_{module}"
-        cursor = connection.cursor()
-        cursor.execute("SELECT * FROM HEAL_archive WHERE module_ID = %s AND DATE(timestamp) BETWEEN %s AND %s ORDER BY timestamp DESC", (module_name, start_date, end_date))
-        module_history_log = cursor.fetchall()
-        cursor.close()
-
-        # present history as dataframe
-        module_history_data = {
-            "Status": [log[1] for log in module_history_log],
-            "Timestamp": [log[2] for log in module_history_log],
-            "Module ID": [log[3] for log in module_history_log],
-            "Sub Module": [log[4] for log in module_history_log],
-            "Message": [log[6] for log in module_history_log],
-        }
-        df = pd.DataFrame(module_history_data)
+        cursors = module_history_cursors((module_name, start_date, end_date, tuple(types)))
+
+        def history_page():
+            module_history_log, next_cursor = get_module_history_page(module_name, start_date, end_date, types, cursors[-1])
 
-        # warning and error msgs are highlighted for easy reference
-        styled_df = df.style.apply(style_df).map(highlight_errors, subset=["Status"])
+            # present the page as dataframe
+            df = pd.DataFrame(
+                [log[1:] for log in module_history_log],
+                columns=["Status", "Timestamp", "Module ID", "Sub Module", "Message"],
+            )
+
+            # warning and error msgs are highlighted for easy reference
+            return df.style.apply(style_df).map(highlight_errors, subset=["Status"]), next_cursor
+
+        page_key = (module_name, start_date, end_date, tuple(types), cursors[-1], cache_generation())
+        styled_df, next_cursor = panel_value("module_history_page", page_key, history_page)
         st.dataframe(styled_df, use_container_width=True, hide_index=True)
 
+        cols = st.columns([15, 70, 15])
+        cols[0].button("Newer", key="module_history_newer", disabled=len(cursors) == 1, on_click=previous_module_history_page, use_container_width=True)
+        cols[1].caption(f"Page {len(cursors)}")
+        cols[2].button("Older", key="module_history_older", disabled=next_cursor is None, on_click=next_module_history_page, args=(next_cursor,), use_container_width=True)
+
         st.divider()
 
         st.write("app response time")
         app_response_container = st.container(border=True)
         with app_response_container:
-            cols = st.columns(3)
-            cols[0].metric("myfunc", value="0.002ms", delta="0.0032")
-            cols[1].metric("myfunc2", value="0.102ms", delta="0.0057")
-            cols[2].metric("myfunc3", value="0.102ms", delta="0.0057")
+            perf_snapshot = perf_worker.snapshot()
+            latencies = get_app_latencies(perf_snapshot.latencies, module)
+            show_latency_metrics(st.columns(3), latencies)
+
+            # percentiles over the selected dates, merged from the stored hourly sketches
+            def range_percentiles():
+                range_start, range_end = day_range(start_date, end_date)
+                rows = []
+                for function in latencies:
+                    percentiles = get_latency_percentiles(f"PERF_{module}", function, range_start, range_end)
+                    rows.append({"Function": function, **{name.removesuffix("_ms"): format_latency(percentiles[name]) for name in quantiles}})
+                return pd.DataFrame(rows)
+
+            if latencies:
+                st.caption(f"{start_date} to {end_date}")
+                st.dataframe(panel_value("module_range_latencies", (module, start_date, end_date, perf_snapshot.version), range_percentiles),
+                             hide_index=True, use_container_width=True)
 
         st.write("app usage")
         data = {
@@ -217,4 +358,27 @@ with module_col:
             "timestamp": ["2024-03-04 13:33:23,451"],
             "usage_history": ["column config line"]
         }
-        st.dataframe(pd.DataFrame(data).style.apply(style_df), hide_index=True, use_container_width=True)
\ No newline at end of file
+        st.dataframe(pd.DataFrame(data).style.apply(style_df), hide_index=True, use_container_width=True)
+
+
+server_col, service_col, module_col = st.columns([30, 35, 35])
+
+with server_col:
+    with st.container(border=True):
+        server_overview()
+    storage_history()
+
+with service_col:
+    service_status()
+
+with module_col:
+    module_table()
+
+profile_path = profiler.finish()
+if profile_path:
+    # only the requested rerun is profiled
+    del st.query_params["profile"]
+    st.toast(f"Profile written to {profile_path}")
+elif profiler.refused:
+    del st.query_params["profile"]
+    st.toast("Another rerun is being profiled, try again once it has finished")
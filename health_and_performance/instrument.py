@@ -0,0 +1,221 @@
+import atexit
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from data import current_dir
+
+logger = logging.getLogger(__name__)
+
+# samples go next to the other perf logs so the perf worker picks them up like any app's
+samples_file = os.path.join(current_dir, "perf_log_files", "dashboard.csv")
+samples_module = "PERF_DASH"
+# off until the dashboard calls enable_samples(), so the command line tools sharing these modules write nothing
+enabled = False
+# the samples file is renamed to dashboard.csv.1 past this size, which the perf worker no longer reads
+max_samples_bytes = 8 * 1024 * 1024
+# samples are kept in memory and appended at most this often, every append wakes the perf worker
+flush_seconds = 10
+# cProfile and tracemalloc output of profiled reruns
+profile_folder = os.path.join(current_dir, "profiles")
+profile_top_lines = 40
+# a profiled rerun that never finished, e.g. cut short by a newer rerun, is given up after this long
+profile_timeout_seconds = 300
+# panels refresh on a timer and mostly hit the caches, only every nth hit is written out
+hit_sample_every = 100
+
+write_lock = threading.Lock()
+pending_samples = []
+last_flush = time.monotonic()
+cache_counts = Counter()
+# tracemalloc traces the whole process, so only one rerun is profiled at a time
+profile_lock = threading.Lock()
+active_profiler = None
+# set while a cached function body runs, i.e. on a cache miss
+computing = threading.local()
+
+
+# write timing samples from this process unless HEAL_INSTRUMENT=0
+def enable_samples():
+    global enabled
+    enabled = os.environ.get("HEAL_INSTRUMENT", "1") != "0"
+
+
+# queue one record in the perf log format, e.g.
+# "INFO","2024-03-04 13:11:23","451","PERF_DASH","db.query","95","time=12.4ms cache=miss"
+def write_sample(stage, ms, line_number=0, note=""):
+    if not enabled:
+        return
+    now = datetime.now()
+    message = f"time={ms:.3f}ms{f' {note}' if note else ''}"
+    record = f'"INFO","{now:%Y-%m-%d %H:%M:%S}","{now.microsecond // 1000:03d}","{samples_module}","{stage}","{line_number}","{message}"\n'
+    with write_lock:
+        pending_samples.append(record)
+        if time.monotonic() - last_flush >= flush_seconds:
+            append_samples()
+
+
+# append the queued records in one write, call with write_lock held
+def append_samples():
+    global last_flush
+    last_flush = time.monotonic()
+    if not pending_samples:
+        return
+    records = "".join(pending_samples)
+    pending_samples.clear()
+    try:
+        if os.path.exists(samples_file) and os.path.getsize(samples_file) >= max_samples_bytes:
+            os.replace(samples_file, f"{samples_file}.1")
+        with open(samples_file, "a", encoding="utf-8") as f:
+            f.write(records)
+    except OSError:
+        logger.exception("could not write %d dashboard timing samples", records.count("\n"))
+
+
+@atexit.register
+def flush_samples():
+    with write_lock:
+        append_samples()
+
+
+# Times a stage and writes it as a perf record, see timed
+class Timed:
+    def __init__(self, stage, line_number=0):
+        self.stage = stage
+        self.line_number = line_number
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        write_sample(self.stage, (time.perf_counter() - self.started) * 1000, self.line_number)
+        return False
+
+    def __call__(self, func):
+        stage, line_number = self.stage, func.__code__.co_firstlineno
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                write_sample(stage, (time.perf_counter() - started) * 1000, line_number)
+        return wrapper
+
+
+# use as a decorator or a context manager:
+#     @timed("util.get_storage_history")
+#     with timed("db.query"):
+def timed(stage):
+    return Timed(stage, sys._getframe(1).f_lineno)
+
+
+# count a cache lookup and write it with its time, misses always and hits every hit_sample_every
+def record_cache(stage, hit, ms, line_number=0):
+    outcome = "hit" if hit else "miss"
+    cache_counts[(stage, outcome)] += 1
+    if hit and (cache_counts[(stage, outcome)] - 1) % hit_sample_every:
+        return
+    write_sample(stage, ms, line_number, f"cache={outcome}")
+
+
+# Wrap func in a cache decorator such as st.cache_data(...) and record whether each
+# call was served from the cache: the cached body only runs on a miss.
+def track_cache(stage, cache):
+    def decorate(func):
+        @functools.wraps(func)
+        def compute(*args, **kwargs):
+            computing.missed = True
+            return func(*args, **kwargs)
+
+        cached = cache(compute)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            computing.missed = False
+            started = time.perf_counter()
+            result = cached(*args, **kwargs)
+            record_cache(stage, not computing.missed, (time.perf_counter() - started) * 1000, func.__code__.co_firstlineno)
+            return result
+
+        wrapper.clear = getattr(cached, "clear", None)
+        return wrapper
+    return decorate
+
+
+def cache_stats():
+    stats = {}
+    for (stage, outcome), count in cache_counts.items():
+        stats.setdefault(stage, {"hit": 0, "miss": 0})[outcome] = count
+    return stats
+
+
+# Profiles one rerun with cProfile and tracemalloc when asked to, e.g. with ?profile=1,
+# and writes the stats to profiles/ when the rerun finishes. Refused while another
+# session's rerun is being profiled, see refused.
+class RerunProfiler:
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.refused = False
+        self.profiler = None
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.profile and not self.claim():
+            logger.warning("not profiling this rerun, another one is being profiled")
+            self.profile = False
+            self.refused = True
+        if self.profile:
+            tracemalloc.start()
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def claim(self):
+        global active_profiler
+        with profile_lock:
+            if active_profiler is not None:
+                if time.perf_counter() - active_profiler.started < profile_timeout_seconds:
+                    return False
+                # its rerun never finished, drop what it traced
+                tracemalloc.stop()
+            active_profiler = self
+            return True
+
+    # returns the path of the written profile, if this rerun was profiled
+    def finish(self):
+        global active_profiler
+        write_sample("health.rerun", (time.perf_counter() - self.started) * 1000)
+        if self.profiler is None:
+            return None
+
+        self.profiler.disable()
+        snapshot = None
+        with profile_lock:
+            # a profile given up after profile_timeout_seconds no longer owns tracemalloc
+            if active_profiler is self:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                active_profiler = None
+
+        os.makedirs(profile_folder, exist_ok=True)
+        path = os.path.join(profile_folder, f"rerun-{datetime.now():%Y%m%d-%H%M%S}")
+        self.profiler.dump_stats(f"{path}.prof")
+        with open(f"{path}.txt", "w") as f:
+            stats = pstats.Stats(self.profiler, stream=f)
+            stats.sort_stats("cumulative").print_stats(profile_top_lines)
+            if snapshot is not None:
+                f.write("\ntop allocations still held at the end of the rerun:\n")
+                for stat in snapshot.statistics("lineno")[:profile_top_lines]:
+                    f.write(f"{stat}\n")
+        return f"{path}.prof"
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import pandas as pd
+from data import get_new_logs, read_file_head, categorical_columns, current_dir
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+cache_folder = os.path.join(current_dir, ".log_cache")
+# rows buffered per log file before they are written out as another part
+part_rows = 100000
+# parts of one log file are merged back into one once there are this many
+max_parts = 16
+
+
+# Parquet copy of the typed rows parsed from every log file, so a restart memory maps
+# them instead of parsing the csvs again. Each log file has a folder of immutable
+# part files and a meta.json naming the parts and the byte offset they cover.
+# A cache is dropped when its file has a new inode, different leading bytes, shrank
+# below the cached offset or changed mtime without changing size, otherwise only
+# the bytes after the cached offset still have to be parsed.
+class LogCache:
+    def __init__(self, cache_folder=cache_folder, part_rows=part_rows):
+        self.cache_folder = cache_folder
+        self.part_rows = part_rows
+        self.enabled = pq is not None
+        # rows parsed since the last part was written, per log file
+        self.pending = {}
+
+    def entry_folder(self, log_file):
+        digest = hashlib.sha1(os.path.abspath(log_file).encode()).hexdigest()[:12]
+        return os.path.join(self.cache_folder, f"{os.path.basename(log_file)}-{digest}")
+
+    def read_meta(self, log_file):
+        try:
+            with open(os.path.join(self.entry_folder(log_file), "meta.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_meta(self, log_file, meta):
+        path = os.path.join(self.entry_folder(log_file), "meta.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(f"{path}.tmp", path)
+
+    def drop(self, log_file):
+        shutil.rmtree(self.entry_folder(log_file), ignore_errors=True)
+
+    def is_fresh(self, meta, stat, head):
+        if meta["inode"] != stat.st_ino or stat.st_size < meta["offset"]:
+            return False
+        cached_head = bytes.fromhex(meta["head"])
+        known = min(len(cached_head), len(head))
+        if cached_head[:known] != head[:known]:
+            return False
+        # same size but touched means rewritten in place
+        return stat.st_size != meta["size"] or stat.st_mtime_ns == meta["mtime_ns"]
+
+    # cached rows of every log file in the tailer's folder, moving the tailer past them
+    def load(self, tailer):
+        if not self.enabled:
+            return []
+        log_files_data = []
+        for log_file in sorted(get_new_logs(tailer.folder_path)):
+            meta = self.read_meta(log_file)
+            if meta is None:
+                continue
+            try:
+                stat = os.stat(log_file)
+                head = read_file_head(log_file)
+                if not self.is_fresh(meta, stat, head):
+                    self.drop(log_file)
+                    continue
+                frames = [pq.read_table(os.path.join(self.entry_folder(log_file), part), memory_map=True).to_pandas()
+                          for part in meta["parts"]]
+            except Exception:
+                logger.exception("dropping unreadable log cache of %s", log_file)
+                self.drop(log_file)
+                continue
+
+            tailer.files[log_file] = {"inode": meta["inode"], "offset": meta["offset"], "size": 0, "head": head}
+            log_files_data.extend(df for df in frames if not df.empty)
+        return log_files_data
+
+    # remember rows parsed from log_file[start:offset], a range starting at 0 replaces the cache
+    def add(self, log_file, start, df, offset):
+        if not self.enabled:
+            return
+        if start == 0:
+            self.pending.pop(log_file, None)
+            self.drop(log_file)
+        pending = self.pending.setdefault(log_file, {"frames": [], "rows": 0})
+        pending["frames"].append(df)
+        pending["rows"] += len(df)
+        pending["offset"] = offset
+
+    # write a part for every log file with enough pending rows, or all of them when forced
+    def flush(self, force=False):
+        for log_file, pending in list(self.pending.items()):
+            if pending["rows"] < self.part_rows and not force:
+                continue
+            del self.pending[log_file]
+            try:
+                self.write_part(log_file, pending)
+            except FileNotFoundError:
+                # rotated away before it could be cached
+                self.drop(log_file)
+            except Exception:
+                logger.exception("failed to cache parsed rows of %s", log_file)
+                self.drop(log_file)
+
+    def write_part(self, log_file, pending):
+        stat = os.stat(log_file)
+        folder = self.entry_folder(log_file)
+        os.makedirs(folder, exist_ok=True)
+        meta = self.read_meta(log_file) or {"parts": [], "next_part": 0}
+
+        stale = []
+        frames = [df for df in pending["frames"] if not df.empty]
+        if frames:
+            if len(meta["parts"]) + 1 >= max_parts:
+                # merge the existing parts into the new one
+                frames = [pq.read_table(os.path.join(folder, name)).to_pandas() for name in meta["parts"]] + frames
+                meta["parts"], stale = [], meta["parts"]
+            part = f"part-{meta['next_part']:05d}.parquet"
+            df = pd.concat(frames, ignore_index=True)
+            # concatenating categoricals with different categories falls back to object
+            for column in categorical_columns:
+                df[column] = df[column].astype("category")
+            df.to_parquet(os.path.join(folder, part), index=False)
+            meta["parts"].append(part)
+            meta["next_part"] += 1
+
+        meta.update({
+            "inode": stat.st_ino,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "offset": pending["offset"],
+            "head": read_file_head(log_file).hex(),
+        })
+        self.write_meta(log_file, meta)
+        for name in stale:
+            os.remove(os.path.join(folder, name))
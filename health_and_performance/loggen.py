@@ -0,0 +1,172 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from data import service_checks
+
+# synthetic modules after the server module SR01 cycle through these prefixes
+module_prefixes = ["ET", "AS", "AI", "VN"]
+server_functions = ["poller", "distributor", "queue", "collector"]
+app_functions = ["myfunc1", "myfunc2", "myfunc3", "myfunc4", "myfunc5"]
+perf_functions = ["db_latency", "queue_latency", "get_usage", "kc_latency", "file_counter"]
+
+type_weights = {"INFO": 0.8, "DEBUG": 0.15, "WARNING": 0.035, "ERROR": 0.012, "CRITICAL": 0.003}
+disk_gb = 200
+start_time = np.datetime64("2024-03-04T00:00:00.000")
+# rows generated and written per step, bounds memory at 10^7 rows
+chunk_rows = 1000000
+
+
+def module_names(modules, kind="HEAL"):
+    names = [f"{kind}_SR01"]
+    for index in range(modules - 1):
+        prefix = module_prefixes[index % len(module_prefixes)]
+        names.append(f"{kind}_{prefix}{index // len(module_prefixes) + 1:02d}")
+    return names
+
+
+def server_names(servers):
+    return [f"ip=10.0.{index // 250}.{index % 250 + 1}" for index in range(servers)]
+
+
+def disk_names(disks):
+    return [f"/dev/sd{chr(ord('a') + index % 26)}{'' if index < 26 else index // 26}" for index in range(disks)]
+
+
+def quoted(*columns):
+    line = '"' + columns[0]
+    for column in columns[1:]:
+        line = line + '","' + column
+    return line + '"'
+
+
+# 2024-03-04 13:16:23,451 from datetime64[ms]
+def format_timestamps(timestamps, milliseconds=True):
+    text = pd.Series(np.datetime_as_string(timestamps, unit="ms")).str.replace("T", " ", regex=False)
+    if milliseconds:
+        return text.str.replace(".", ",", regex=False)
+    return text.str.slice(0, 19)
+
+
+def timestamps_for(chunk_start, count, total, days):
+    step_ms = max(days * 86400000 // max(total, 1), 1)
+    return start_time + (np.arange(chunk_start, chunk_start + count) * step_ms).astype("timedelta64[ms]")
+
+
+# One chunk of HEAL rows in time order. check_share of the rows are the server module's
+# checks: check_hdd per server and disk with usage creeping up over the period, and the
+# service checks per server. The rest are app function logs spread over the modules.
+def heal_chunk(rng, chunk_start, count, total, modules, servers, disks, days, check_share):
+    timestamps = timestamps_for(chunk_start, count, total, days)
+    types = rng.choice(list(type_weights), size=count, p=list(type_weights.values()))
+    is_check = rng.random(count) < check_share
+
+    module_list = module_names(modules)
+    module_ids = np.where(is_check, module_list[0], np.array(module_list)[rng.integers(0, len(module_list), count)])
+
+    server_list, disk_list = server_names(servers), disk_names(disks)
+    server_index = rng.integers(0, len(server_list), count)
+    disk_index = rng.integers(0, len(disk_list), count)
+    # half of the checks look at disks, the rest at services
+    is_hdd = is_check & (rng.random(count) < 0.5)
+    services = np.array(service_checks)[rng.integers(0, len(service_checks), count)]
+    functions = np.array(server_functions + app_functions)[rng.integers(0, len(server_functions) + len(app_functions), count)]
+    sub_modules = np.where(is_hdd, "check_hdd", np.where(is_check, services, functions))
+
+    # each disk starts at its own level and fills at its own rate
+    disk_seed = np.random.default_rng(len(disk_list) * 1000 + len(server_list))
+    base = disk_seed.uniform(0.1, 0.6, (len(server_list), len(disk_list)))
+    rate = disk_seed.uniform(0.0, 0.35, (len(server_list), len(disk_list)))
+    progress = (chunk_start + np.arange(count)) / max(total, 1)
+    used_share = base[server_index, disk_index] + rate[server_index, disk_index] * progress + rng.normal(0, 0.005, count)
+    used = np.clip(np.round(used_share * disk_gb), 0, disk_gb).astype(int)
+
+    servers_text = pd.Series(np.array(server_list)[server_index])
+    hdd_messages = (servers_text + "|" + pd.Series(np.array(disk_list)[disk_index]) + "|"
+                    + pd.Series(used).astype(str) + "gb|" + pd.Series(disk_gb - used).astype(str) + "gb")
+    messages = pd.Series(np.where(is_hdd, hdd_messages, np.where(is_check, servers_text, "<message>")))
+
+    return pd.DataFrame({
+        "module_id": module_ids,
+        "line": quoted(
+            pd.Series(types),
+            format_timestamps(timestamps),
+            pd.Series(module_ids),
+            pd.Series(sub_modules),
+            pd.Series(rng.integers(1, 500, count)).astype(str),
+            messages,
+        ),
+    })
+
+
+# One chunk of PERF rows in time order with log-normal latencies per function
+def perf_chunk(rng, chunk_start, count, total, modules, days):
+    timestamps = timestamps_for(chunk_start, count, total, days)
+    module_ids = np.array(module_names(modules, "PERF"))[rng.integers(0, modules, count)]
+    function_index = rng.integers(0, len(perf_functions), count)
+    latency_ms = rng.lognormal(mean=1.0 + function_index, sigma=0.6)
+    in_seconds = latency_ms >= 1000
+    times = np.where(in_seconds, np.char.mod("%.3gs", latency_ms / 1000), np.char.mod("%.3gms", latency_ms))
+
+    return pd.DataFrame({
+        "module_id": module_ids,
+        "line": quoted(
+            pd.Series(["INFO"] * count),
+            format_timestamps(timestamps, milliseconds=False),
+            pd.Series(timestamps.astype("datetime64[ms]").astype(np.int64) % 1000).astype(str).str.zfill(3),
+            pd.Series(module_ids),
+            pd.Series(np.array(perf_functions)[function_index]),
+            pd.Series(rng.integers(1, 500, count)).astype(str),
+            "time=" + pd.Series(times),
+        ),
+    })
+
+
+# append each chunk's lines to one csv per module, returns the files written
+def write_chunks(folder, chunks):
+    os.makedirs(folder, exist_ok=True)
+    files = {}
+    for chunk in chunks:
+        for module_id, lines in chunk.groupby("module_id", sort=False)["line"]:
+            path = os.path.join(folder, f"{module_id.split('_', 1)[1]}.csv")
+            files[module_id] = path
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+    return sorted(files.values())
+
+
+def write_heal_logs(folder, rows, modules=10, servers=2, disks=2, days=30, check_share=0.3, seed=0):
+    rng = np.random.default_rng(seed)
+    chunks = (heal_chunk(rng, start, min(chunk_rows, rows - start), rows, modules, servers, disks, days, check_share)
+              for start in range(0, rows, chunk_rows))
+    return write_chunks(folder, chunks)
+
+
+def write_perf_logs(folder, rows, modules=10, days=30, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    chunks = (perf_chunk(rng, start, min(chunk_rows, rows - start), rows, modules, days)
+              for start in range(0, rows, chunk_rows))
+    return write_chunks(folder, chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="write synthetic HEAL and PERF log files")
+    parser.add_argument("folder", help="log_files/ and perf_log_files/ are created inside it")
+    parser.add_argument("--rows", type=float, default=1e5, help="HEAL rows, e.g. 1e6")
+    parser.add_argument("--perf-rows", type=float, help="PERF rows, defaults to a tenth of --rows")
+    parser.add_argument("--modules", type=int, default=10)
+    parser.add_argument("--servers", type=int, default=2)
+    parser.add_argument("--disks", type=int, default=2, help="disks per server")
+    parser.add_argument("--days", type=int, default=30, help="period the rows are spread over")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rows = int(args.rows)
+    perf_rows = int(args.perf_rows if args.perf_rows is not None else rows // 10)
+    heal_files = write_heal_logs(os.path.join(args.folder, "log_files"), rows, args.modules, args.servers, args.disks, args.days, seed=args.seed)
+    perf_files = write_perf_logs(os.path.join(args.folder, "perf_log_files"), perf_rows, args.modules, args.days, seed=args.seed)
+    print(f"wrote {rows} HEAL rows to {len(heal_files)} files and {perf_rows} PERF rows to {len(perf_files)} files under {args.folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from data import current_dir, read_log_range, read_file_head
+from db import fetch_all, get_connection
+from sketch import DDSketch
+
+perf_folder_path = os.path.join(current_dir, "perf_log_files")
+
+# perf records carry the milliseconds of the timestamp as their own column, e.g.
+# "INFO","2024-03-04 13:11:23","451","PERF_SR01","poller","286","time=5.22min"
+perf_column_names = ["type", "timestamp", "milliseconds", "module_id", "sub_module_name", "line_number", "message"]
+
+# milliseconds per unit of the time= values
+time_units = {"us": 0.001, "ms": 1.0, "s": 1000.0, "sec": 1000.0, "min": 60000.0, "h": 3600000.0}
+time_pattern = r"time=\s*(\d+(?:\.\d+)?)\s*(us|ms|sec|s|min|h)\b"
+
+# recent samples kept per function for the rolling mean
+window_size = 500
+
+# latency percentiles are kept as one quantile sketch per function and hour,
+# the widgets compare the latest percentile_window_buckets with the ones before
+sketch_bucket = "h"
+percentile_window_buckets = 1
+retained_buckets = 48
+quantiles = {"p50_ms": 0.5, "p95_ms": 0.95, "p99_ms": 0.99}
+
+
+# time=5.22min, time=0.22s, time=0.2ms ... to milliseconds, NaN when there is no time
+def parse_perf_times(messages):
+    parts = pd.Series(messages, dtype=object).str.extract(time_pattern)
+    return parts[0].astype(float) * parts[1].map(time_units).astype(float)
+
+
+# parsed perf frames with a numeric time_ms column, rows without a time dropped
+def get_perf_data(perf_files_data):
+    frames = []
+    for df in perf_files_data:
+        frames.append(df.assign(time_ms=parse_perf_times(df["message"])).dropna(subset=["time_ms"]))
+    return frames
+
+
+# 1.5s, 220ms, 5.22min ... in the unit that reads best
+def format_latency(ms):
+    if ms is None or np.isnan(ms):
+        return "-"
+    if ms >= 60000:
+        return f"{ms / 60000:.3g}min"
+    if ms >= 1000:
+        return f"{ms / 1000:.3g}s"
+    return f"{ms:.3g}ms"
+
+
+# percentiles of a merged set of sketches, NaN when they hold no samples
+def sketch_percentiles(sketches):
+    merged = DDSketch()
+    for sketch in sketches:
+        merged.merge(sketch)
+    return {name: merged.quantile(q) for name, q in quantiles.items()}
+
+
+# Rolling latency statistics per (module, function). Batches are grouped once with
+# pandas and only the last window_size samples of each function are kept, plus one
+# quantile sketch per hour bucket for the percentiles, so memory per function is
+# bounded no matter how many samples arrive.
+class PerfStats:
+    def __init__(self, window_size=window_size, retained_buckets=retained_buckets):
+        self.window_size = window_size
+        self.retained_buckets = retained_buckets
+        self.functions = {}
+        # samples not merged into PERF_sketch yet, per (module, function, bucket start).
+        # Kept apart from the in-memory sketches so a bucket dropped from memory is still saved
+        self.unsaved = {}
+
+    # samples that are already in PERF_sketch are passed with save=False
+    def update(self, perf_data, save=True):
+        if not perf_data:
+            return
+        df = pd.concat(perf_data, ignore_index=True)
+        for (module_id, function), times in df.groupby(["module_id", "sub_module_name"], sort=False)["time_ms"]:
+            stats = self.functions.setdefault((module_id, function), {"count": 0, "window": np.empty(0), "sketches": {}})
+            stats["count"] += len(times)
+            stats["window"] = np.concatenate([stats["window"], times.to_numpy(dtype=float)])[-self.window_size:]
+
+        buckets = pd.to_datetime(df["timestamp"], format="%Y-%m-%d %H:%M:%S", errors="coerce").dt.floor(sketch_bucket)
+        timed = df.assign(bucket_start=buckets).dropna(subset=["bucket_start"])
+        for (module_id, function, bucket_start), times in timed.groupby(["module_id", "sub_module_name", "bucket_start"], sort=False)["time_ms"]:
+            sketches = self.functions[(module_id, function)]["sketches"]
+            bucket_start = bucket_start.to_pydatetime()
+            values = times.to_numpy(dtype=float)
+            sketches.setdefault(bucket_start, DDSketch()).add(values)
+            if save:
+                self.unsaved.setdefault((module_id, function, bucket_start), DDSketch()).add(values)
+
+        # only recent buckets stay in memory, older ones live in PERF_sketch
+        for stats in self.functions.values():
+            for bucket_start in sorted(stats["sketches"])[:-self.retained_buckets]:
+                del stats["sketches"][bucket_start]
+
+    # serialized samples added since the last call, as PERF_sketch rows to merge into the stored ones
+    def pop_unsaved_sketches(self):
+        rows = [(module_id, function, bucket_start, sketch.count, sketch.to_bytes())
+                for (module_id, function, bucket_start), sketch in self.unsaved.items()]
+        self.unsaved = {}
+        return rows
+
+    # rows that could not be saved go back, together with any samples added since
+    def restore_unsaved(self, rows):
+        for module_id, function, bucket_start, _, data in rows:
+            self.unsaved.setdefault((module_id, function, bucket_start), DDSketch()).merge(DDSketch.from_bytes(data))
+
+    # plain values per function, safe to hand to readers while updates continue
+    def summary(self):
+        summary = {}
+        for key, stats in self.functions.items():
+            window = stats["window"]
+            buckets = sorted(stats["sketches"])
+            latest = [stats["sketches"][bucket] for bucket in buckets[-percentile_window_buckets:]]
+            before = [stats["sketches"][bucket] for bucket in buckets[-2 * percentile_window_buckets:-percentile_window_buckets]]
+            summary[key] = {
+                "count": stats["count"],
+                "last_ms": float(window[-1]),
+                "previous_ms": float(window[-2]) if len(window) > 1 else np.nan,
+                "mean_ms": float(window.mean()),
+                **sketch_percentiles(latest),
+                "previous_p95_ms": sketch_percentiles(before)["p95_ms"],
+            }
+        return summary
+
+
+lock_sketch_query = "SELECT sketch FROM PERF_sketch WHERE module_ID = %s AND function_name = %s AND bucket_start = %s FOR UPDATE"
+save_sketch_query = """
+INSERT INTO PERF_sketch (module_ID, function_name, bucket_start, sample_count, sketch)
+VALUES (%s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE sample_count = VALUES(sample_count), sketch = VALUES(sketch)
+"""
+load_sketches_query = "SELECT sketch FROM PERF_sketch WHERE module_ID = %s AND function_name = %s AND bucket_start >= %s AND bucket_start < %s"
+load_perf_checkpoints = "SELECT file_path, inode, offset, head FROM PERF_sketch_checkpoint"
+save_perf_checkpoint = """
+INSERT INTO PERF_sketch_checkpoint (file_path, inode, offset, head, updated_at)
+VALUES (%s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE inode = VALUES(inode), offset = VALUES(offset), head = VALUES(head), updated_at = VALUES(updated_at)
+"""
+
+
+# Each row only holds the samples read since the last save, so it is merged into the
+# stored sketch of its bucket. The perf log offsets the samples were read up to are
+# committed in the same transaction, so a restart does not count them twice.
+def save_sketches(rows, checkpoints=()):
+    if not rows and not checkpoints:
+        return
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            for module_id, function, bucket_start, _, data in rows:
+                cursor.execute(lock_sketch_query, (module_id, function, bucket_start))
+                stored = cursor.fetchone()
+                sketch = DDSketch.from_bytes(data)
+                if stored is not None:
+                    sketch.merge(DDSketch.from_bytes(stored[0]))
+                cursor.execute(save_sketch_query, (module_id, function, bucket_start, sketch.count, sketch.to_bytes()))
+            now = datetime.now()
+            cursor.executemany(save_perf_checkpoint, [(*checkpoint, now) for checkpoint in checkpoints])
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+
+# {file: (inode, offset, head)} of the perf log bytes already merged into PERF_sketch
+def get_perf_checkpoints():
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(load_perf_checkpoints)
+        rows = cursor.fetchall()
+        cursor.close()
+    return {file_path: (inode, offset, bytes(head)) for file_path, inode, offset, head in rows}
+
+
+# Parse the saved part of every perf log that is still the file it was saved from,
+# as (file, inode, offset, head, rows). Files that were rotated, truncated or
+# rewritten since are left out and read again from the start.
+def read_saved_ranges(checkpoints):
+    ranges = []
+    for log_file, (inode, offset, head) in checkpoints.items():
+        try:
+            stat = os.stat(log_file)
+            current_head = read_file_head(log_file)
+        except FileNotFoundError:
+            continue
+        known = min(len(head), len(current_head))
+        if stat.st_ino != inode or stat.st_size < offset or head[:known] != current_head[:known]:
+            continue
+        df, _ = read_log_range(log_file, 0, offset, perf_column_names)
+        ranges.append((log_file, inode, offset, current_head, df))
+    return ranges
+
+
+# percentiles of a function over any range, merged from the stored hourly sketches
+def get_latency_percentiles(module_id, function, start, end):
+    rows = fetch_all(load_sketches_query, (module_id, function, start, end))
+    return sketch_percentiles(DDSketch.from_bytes(sketch) for (sketch,) in rows)
+
+
+# apps with perf records, without the PERF_ prefix
+def get_perf_apps(perf_summary):
+    return sorted({module_id.split("_", 1)[-1] for module_id, _ in perf_summary})
+
+
+def get_app_latencies(perf_summary, app):
+    return {function: stats for (module_id, function), stats in perf_summary.items() if module_id == f"PERF_{app}"}
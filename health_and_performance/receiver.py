@@ -0,0 +1,360 @@
+import argparse
+import asyncio
+import io
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from archive import BatchArchiver
+from data import column_names
+from instrument import write_sample
+from loggen import heal_chunk, perf_chunk
+from perf import perf_column_names
+
+logger = logging.getLogger(__name__)
+
+# agents send HEAL and PERF lines in the log file csv format to one port, over tcp or udp
+receiver_host = os.environ.get("HEAL_RECEIVER_HOST", "0.0.0.0")
+receiver_port = int(os.environ.get("HEAL_RECEIVER_PORT", "5140"))
+# the dashboard only listens when a port is configured
+receiver_enabled = "HEAL_RECEIVER_PORT" in os.environ
+# how long start() waits for the sockets to be bound
+start_timeout_seconds = 10
+
+read_bytes = 64 * 1024
+# chunks of tcp lines waiting to be parsed, at most queue_chunks * read_bytes are held
+queue_chunks = 256
+# udp has no flow control, datagrams beyond this many waiting bytes are dropped
+max_datagram_bytes = 16 * 1024 * 1024
+# kernel buffer for datagrams arriving while a batch holds the interpreter, capped by net.core.rmem_max
+udp_receive_buffer = 8 * 1024 * 1024
+# a micro-batch is applied once it holds batch_bytes or its first lines are batch_seconds old
+batch_bytes = 4 * 1024 * 1024
+batch_seconds = 0.5
+# how long a part filled batch waits before looking for more lines
+idle_seconds = 0.01
+# a line longer than this is dropped rather than buffered
+max_line_bytes = 64 * 1024
+# udp datagrams of the load generator stay below a typical mtu
+datagram_size = 1400
+
+
+# Received lines as HEAL and PERF frames with the column names the tailers use.
+# HEAL lines have six fields with the module third, PERF lines seven with the module
+# fourth; everything else is counted as bad. Returns (heal, perf, bad line count).
+def split_batch(data):
+    lines = data.count(b"\n")
+    df = pd.read_csv(io.BytesIO(data), header=None, names=range(len(perf_column_names)), dtype=str,
+                     index_col=False, on_bad_lines="skip")
+    is_perf = df[3].str.startswith("PERF_", na=False) & df[6].notna()
+    is_heal = ~is_perf & df[5].notna() & df[6].isna()
+    heal = df.loc[is_heal, list(range(len(column_names)))].set_axis(column_names, axis=1).reset_index(drop=True)
+    perf = df.loc[is_perf].set_axis(perf_column_names, axis=1).reset_index(drop=True)
+    return heal, perf, max(lines - len(heal) - len(perf), 0)
+
+
+# datagrams are buffered on the receiver and picked up with the next batch
+class DatagramReceiver(asyncio.DatagramProtocol):
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def datagram_received(self, data, addr):
+        self.receiver.add_datagram(data)
+
+
+# Accepts lines from many agents over tcp and udp and applies them in micro-batches.
+# on_heal and on_perf are given each batch's HEAL and PERF rows as untyped frames,
+# one batch at a time on a worker thread so parsing never stalls the event loop.
+# Backpressure: tcp chunks wait in a bounded queue, and while it is full the
+# connection is not read, so tcp flow control slows the agent down. Datagrams
+# cannot be slowed down, beyond max_datagram_bytes they are dropped and counted.
+class LogReceiver:
+    def __init__(self, on_heal=None, on_perf=None, host=receiver_host, tcp_port=receiver_port, udp_port=receiver_port,
+                 batch_bytes=batch_bytes, batch_seconds=batch_seconds):
+        self.on_heal = on_heal
+        self.on_perf = on_perf
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.batch_bytes = batch_bytes
+        self.batch_seconds = batch_seconds
+        self.stats = Counter()
+        self.loop = None
+        self.queue = None
+        self.arrived = None
+        self.datagrams = []
+        self.datagram_bytes = 0
+        self.task = None
+        self.ready = threading.Event()
+        # why serve() could not listen, raised again by start()
+        self.error = None
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.queue = asyncio.Queue(queue_chunks)
+        self.arrived = asyncio.Event()
+
+        server, transport = None, None
+        try:
+            try:
+                if self.tcp_port is not None:
+                    server = await asyncio.start_server(self.handle_tcp, self.host, self.tcp_port)
+                    self.tcp_port = server.sockets[0].getsockname()[1]
+                if self.udp_port is not None:
+                    transport, _ = await self.loop.create_datagram_endpoint(lambda: DatagramReceiver(self), local_addr=(self.host, self.udp_port))
+                    self.udp_port = transport.get_extra_info("sockname")[1]
+                    transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, udp_receive_buffer)
+            except Exception as error:
+                # e.g. the port is already in use, start() raises it in the caller's thread
+                self.error = error
+                raise
+            finally:
+                self.ready.set()
+            logger.info("receiving logs on %s, tcp port %s, udp port %s", self.host, self.tcp_port, self.udp_port)
+
+            with ThreadPoolExecutor(1, thread_name_prefix="log-receiver") as executor:
+                while True:
+                    data = await self.next_batch()
+                    # the queue keeps filling while the batch is applied, and blocks agents once full
+                    await self.loop.run_in_executor(executor, self.apply_batch, data)
+        finally:
+            if server is not None:
+                server.close()
+            if transport is not None:
+                transport.close()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except asyncio.CancelledError:
+            # stopped
+            pass
+        except Exception:
+            # start() raises startup errors itself
+            if self.error is None:
+                logger.exception("log receiver stopped")
+
+    # serve on a daemon thread with its own event loop, raises when it cannot listen
+    def start(self, timeout=start_timeout_seconds):
+        thread = threading.Thread(target=self.run, name="log-receiver", daemon=True)
+        thread.start()
+        if not self.ready.wait(timeout):
+            self.stop()
+            raise TimeoutError(f"log receiver did not start listening on {self.host} within {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def stop(self):
+        if self.loop is not None and self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    async def handle_tcp(self, reader, writer):
+        self.stats["connections"] += 1
+        tail = b""
+        try:
+            while True:
+                data = await reader.read(read_bytes)
+                if not data:
+                    break
+                self.stats["received_bytes"] += len(data)
+                data = tail + data
+                end = data.rfind(b"\n") + 1
+                tail = data[end:]
+                if len(tail) > max_line_bytes:
+                    self.stats["bad_lines"] += 1
+                    tail = b""
+                if end:
+                    await self.queue.put(data[:end])
+                    self.arrived.set()
+            # the agent closed the connection, its last line is complete
+            if tail.strip():
+                await self.queue.put(tail + b"\n")
+                self.arrived.set()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def add_datagram(self, data):
+        self.stats["received_bytes"] += len(data)
+        if self.datagram_bytes + len(data) > max_datagram_bytes:
+            self.stats["dropped_lines"] += data.count(b"\n") + (not data.endswith(b"\n"))
+            return
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        self.datagrams.append(data)
+        self.datagram_bytes += len(data)
+        self.arrived.set()
+
+    # wait for lines and gather them until the batch is full or old enough
+    async def next_batch(self):
+        chunks, size, deadline = [], 0, None
+        while True:
+            self.arrived.clear()
+            while size < self.batch_bytes and not self.queue.empty():
+                chunk = self.queue.get_nowait()
+                chunks.append(chunk)
+                size += len(chunk)
+            if self.datagrams:
+                chunks.extend(self.datagrams)
+                size += self.datagram_bytes
+                self.datagrams, self.datagram_bytes = [], 0
+
+            if not chunks:
+                await self.arrived.wait()
+                continue
+            now = self.loop.time()
+            if deadline is None:
+                deadline = now + self.batch_seconds
+            if size >= self.batch_bytes or now >= deadline:
+                return b"".join(chunks)
+            await asyncio.sleep(min(idle_seconds, deadline - now))
+
+    def apply_batch(self, data):
+        started = time.perf_counter()
+        try:
+            heal, perf, bad_lines = split_batch(data)
+        except Exception:
+            logger.exception("dropping a batch of %d bytes that could not be parsed", len(data))
+            self.stats["bad_lines"] += data.count(b"\n")
+            return
+        self.stats.update(batches=1, heal_lines=len(heal), perf_lines=len(perf), bad_lines=bad_lines)
+
+        for kind, sink, df in (("heal", self.on_heal, heal), ("perf", self.on_perf, perf)):
+            if sink is None or df.empty:
+                continue
+            try:
+                sink(df)
+            except Exception:
+                self.stats[f"{kind}_failures"] += 1
+                logger.exception("failed to apply %d received %s lines", len(df), kind.upper())
+        write_sample("receiver.batch", (time.perf_counter() - started) * 1000, note=f"lines={len(heal) + len(perf)}")
+
+    def queued_bytes(self):
+        return (self.queue.qsize() * read_bytes if self.queue is not None else 0) + self.datagram_bytes
+
+
+# HEAL and PERF lines from loggen, about a tenth of them PERF, shuffled together
+def load_lines(rows, modules, servers, disks, seed=0):
+    rng = np.random.default_rng(seed)
+    perf_rows = rows // 10
+    lines = pd.concat([
+        heal_chunk(rng, 0, rows - perf_rows, rows - perf_rows, modules, servers, disks, 1, 0.3)["line"],
+        perf_chunk(rng, 0, perf_rows, perf_rows, modules, 1)["line"],
+    ], ignore_index=True)
+    return lines.take(rng.permutation(len(lines))).tolist()
+
+
+# pack lines into payloads of about size bytes that end on a line
+def pack_lines(lines, size):
+    payloads, current, current_size = [], [], 0
+    for line in lines:
+        encoded = line.encode() + b"\n"
+        if current and current_size + len(encoded) > size:
+            payloads.append(b"".join(current))
+            current, current_size = [], 0
+        current.append(encoded)
+        current_size += len(encoded)
+    if current:
+        payloads.append(b"".join(current))
+    return payloads
+
+
+async def send_tcp(host, port, payloads):
+    reader, writer = await asyncio.open_connection(host, port)
+    for payload in payloads:
+        writer.write(payload)
+        # waits while the receiver is not reading, i.e. applying backpressure
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+
+async def send_udp(host, port, payloads, rate_payloads):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+    started = loop.time()
+    for index, payload in enumerate(payloads):
+        transport.sendto(payload)
+        if rate_payloads and index % 100 == 99:
+            await asyncio.sleep(max(started + (index + 1) / rate_payloads - loop.time(), 0))
+    transport.close()
+
+
+# Local load generator: sends rows synthetic lines over connections tcp connections,
+# or as udp datagrams at rate lines per second, and reports the send rate
+async def send_load(host, port, rows, connections, udp, rate, modules, servers, disks):
+    lines = load_lines(rows, modules, servers, disks)
+    started = time.perf_counter()
+    if udp:
+        payloads = pack_lines(lines, datagram_size)
+        rate_payloads = rate * len(payloads) / len(lines) if rate else None
+        await send_udp(host, port, payloads, rate_payloads)
+    else:
+        shares = [lines[index::connections] for index in range(connections)]
+        await asyncio.gather(*(send_tcp(host, port, pack_lines(share, read_bytes)) for share in shares))
+    seconds = time.perf_counter() - started
+    print(f"sent {len(lines):,} lines over {'udp' if udp else f'{connections} tcp connections'} in {seconds:.2f}s, {len(lines) / seconds:,.0f} lines/s")
+
+
+async def report_loop(receiver, every):
+    previous, previous_at = 0, time.perf_counter()
+    while True:
+        await asyncio.sleep(every)
+        stats, now = receiver.stats, time.perf_counter()
+        lines = stats["heal_lines"] + stats["perf_lines"]
+        if lines != previous:
+            print(f"{(lines - previous) / (now - previous_at):,.0f} lines/s, {stats['heal_lines']:,} HEAL, {stats['perf_lines']:,} PERF, "
+                  f"{stats['bad_lines']:,} bad, {stats['dropped_lines']:,} dropped, {stats['batches']:,} batches, "
+                  f"{receiver.queued_bytes() / 1e6:.1f} MB queued")
+        previous, previous_at = lines, now
+
+
+async def serve_standalone(receiver, every):
+    reporter = asyncio.create_task(report_loop(receiver, every))
+    try:
+        await receiver.serve()
+    finally:
+        reporter.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="receive HEAL and PERF lines from agents over tcp and udp")
+    parser.add_argument("--host", default=receiver_host)
+    parser.add_argument("--port", type=int, default=receiver_port, help="tcp and udp port")
+    parser.add_argument("--archive", action="store_true", help="archive received HEAL lines into HEAL_archive")
+    parser.add_argument("--report", type=float, default=5, help="seconds between throughput reports")
+    parser.add_argument("--send", type=float, help="send this many synthetic lines to --host/--port instead of receiving")
+    parser.add_argument("--connections", type=int, default=4, help="tcp connections the synthetic lines are spread over")
+    parser.add_argument("--udp", action="store_true", help="send the synthetic lines as udp datagrams")
+    parser.add_argument("--rate", type=float, help="lines per second sent over udp, unlimited by default")
+    parser.add_argument("--modules", type=int, default=10)
+    parser.add_argument("--servers", type=int, default=24)
+    parser.add_argument("--disks", type=int, default=2, help="disks per server")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.send:
+        host = "127.0.0.1" if args.host == "0.0.0.0" else args.host
+        asyncio.run(send_load(host, args.port, int(args.send), args.connections, args.udp, args.rate,
+                              args.modules, args.servers, args.disks))
+        return
+
+    on_heal = None
+    if args.archive:
+        on_heal = BatchArchiver().archive
+    try:
+        asyncio.run(serve_standalone(LogReceiver(on_heal, host=args.host, tcp_port=args.port, udp_port=args.port), args.report))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
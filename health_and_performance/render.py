@@ -0,0 +1,88 @@
+import hashlib
+import io
+import pickle
+import time
+from collections import OrderedDict
+from threading import Lock
+from matplotlib import pyplot as plt
+from instrument import timed, record_cache, write_sample
+
+# rendered charts kept in memory across sessions, least recently used dropped first
+render_cache_max_bytes = 64 * 1024 * 1024
+# same output st.pyplot produced before
+savefig_options = {"format": "png", "dpi": 200, "bbox_inches": "tight"}
+
+
+# content hash of the chart inputs, so equal data from any session shares one render
+def data_key(*args):
+    return hashlib.sha256(pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+
+# LRU of rendered PNG bytes bounded by their total size, with hit/miss counters
+class RenderCache:
+    def __init__(self, max_bytes=render_cache_max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, png, extra):
+        with self.lock:
+            if key in self.entries:
+                self.size_bytes -= len(self.entries.pop(key)[0])
+            self.entries[key] = (png, extra)
+            self.size_bytes += len(png)
+            while self.size_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "size_bytes": self.size_bytes}
+
+
+render_cache = RenderCache()
+
+
+def figure_to_png(fig):
+    buffer = io.BytesIO()
+    try:
+        with timed("render.savefig"):
+            fig.savefig(buffer, facecolor=fig.get_facecolor(), **savefig_options)
+    finally:
+        # drop the figure from pyplot's registry, the png is all that is kept
+        plt.close(fig)
+    return buffer.getvalue()
+
+
+# Render a chart to PNG bytes through the cache. draw returns a figure or
+# (figure, extra); extra is cached alongside the image and returned with it.
+def render_png(draw, *args):
+    started = time.perf_counter()
+    key = (draw.__module__, draw.__qualname__, data_key(*args))
+    entry = render_cache.get(key)
+    record_cache(f"render.{draw.__qualname__}", entry is not None, (time.perf_counter() - started) * 1000)
+    if entry is not None:
+        return entry
+
+    result = draw(*args)
+    fig, extra = result if isinstance(result, tuple) else (result, None)
+    png = figure_to_png(fig)
+    render_cache.put(key, png, extra)
+    # the cache only changes on a miss, so its totals are written with each new render
+    stats = render_cache.stats()
+    write_sample("render.cache", (time.perf_counter() - started) * 1000,
+                 note=" ".join(f"{name}={value}" for name, value in stats.items()))
+    return png, extra
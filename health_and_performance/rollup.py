@@ -0,0 +1,163 @@
+import argparse
+import time
+import mariadb
+import pandas as pd
+from data import service_checks
+from db import connection_params, invalidate_cache
+from schema import rollup_granularities
+from util import parse_hdd_messages
+
+# status levels in rising severity, stored as 1-based worst_level
+status_levels = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+bucket_frequencies = {"hourly": "h", "daily": "D"}
+
+# archive rows read per transaction
+batch_size = 50000
+state_name = "heal_rollups"
+# Archive ids are given out on insert but only become visible on commit, so a long
+# insert can commit ids below ones already rolled up. A run only reads up to the highest
+# id seen by a run at least this long ago, by then every insert below it has committed.
+lag_seconds = 60
+
+archive_columns = ["id", "type", "timestamp", "module_ID", "sub_module_name", "message"]
+
+upsert_storage_rollup = """
+INSERT INTO HEAL_storage_{granularity} (disk, bucket_start, min_used_pct, max_used_pct, last_used_pct, last_timestamp, last_message)
+VALUES (%s, %s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+    min_used_pct = LEAST(min_used_pct, VALUES(min_used_pct)),
+    max_used_pct = GREATEST(max_used_pct, VALUES(max_used_pct)),
+    last_used_pct = IF(VALUES(last_timestamp) >= last_timestamp, VALUES(last_used_pct), last_used_pct),
+    last_message = IF(VALUES(last_timestamp) >= last_timestamp, VALUES(last_message), last_message),
+    last_timestamp = GREATEST(last_timestamp, VALUES(last_timestamp))
+"""
+
+upsert_status_rollup = """
+INSERT INTO HEAL_status_{granularity} (module_ID, sub_module_name, target, bucket_start, debug_count, info_count, warning_count, error_count, critical_count, worst_level)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+    debug_count = debug_count + VALUES(debug_count),
+    info_count = info_count + VALUES(info_count),
+    warning_count = warning_count + VALUES(warning_count),
+    error_count = error_count + VALUES(error_count),
+    critical_count = critical_count + VALUES(critical_count),
+    worst_level = GREATEST(worst_level, VALUES(worst_level))
+"""
+
+
+# min, max and last used % per disk and bucket
+def storage_summary(df, frequency):
+    hdd_rows = df.loc[df["sub_module_name"] == "check_hdd"].sort_values("timestamp", kind="stable")
+    if hdd_rows.empty:
+        return pd.DataFrame()
+    parsed = parse_hdd_messages(hdd_rows["message"])
+    frame = pd.DataFrame({
+        "disk": parsed["server"] + "|" + parsed["partition"],
+        "bucket_start": hdd_rows["timestamp"].dt.floor(frequency),
+        "used_pct": parsed["used_pct"],
+        "timestamp": hdd_rows["timestamp"],
+        "message": hdd_rows["message"],
+    }).dropna()
+    return frame.groupby(["disk", "bucket_start"], sort=False).agg(
+        min_used_pct=("used_pct", "min"),
+        max_used_pct=("used_pct", "max"),
+        last_used_pct=("used_pct", "last"),
+        last_timestamp=("timestamp", "last"),
+        last_message=("message", "last"),
+    ).reset_index()
+
+
+# count of every status level and the worst level per module, sub module, checked server and bucket
+def status_summary(df, frequency):
+    is_service = df["sub_module_name"].isin(service_checks)
+    frame = pd.DataFrame({
+        "module_ID": df["module_ID"],
+        "sub_module_name": df["sub_module_name"],
+        "target": df["message"].where(is_service, ""),
+        "bucket_start": df["timestamp"].dt.floor(frequency),
+        "worst_level": df["type"].map({level: index + 1 for index, level in enumerate(status_levels)}).fillna(0).astype(int),
+    })
+    for level in status_levels:
+        frame[f"{level.lower()}_count"] = (df["type"] == level).astype(int)
+
+    count_columns = [f"{level.lower()}_count" for level in status_levels]
+    aggregations = {column: "sum" for column in count_columns}
+    aggregations["worst_level"] = "max"
+    summary = frame.groupby(["module_ID", "sub_module_name", "target", "bucket_start"], sort=False).agg(aggregations)
+    return summary.reset_index()[["module_ID", "sub_module_name", "target", "bucket_start", *count_columns, "worst_level"]]
+
+
+def upsert(cursor, statement, summary):
+    if not summary.empty:
+        cursor.executemany(statement, list(summary.astype(object).itertuples(index=False, name=None)))
+
+
+# Fold archive rows added since the last run into the hourly and daily rollups.
+# Progress is tracked by archive id and committed together with the rollup rows,
+# so a crashed run resumes without counting any row twice.
+def run_rollup(connection, batch_size=batch_size, lag_seconds=lag_seconds):
+    cursor = connection.cursor()
+    cursor.execute("SELECT last_id, seen_id, seen_at FROM HEAL_rollup_state WHERE name = %s", (state_name,))
+    last_id, seen_id, seen_at = cursor.fetchone() or (0, 0, None)
+
+    # ids seen lag_seconds ago are settled, the ids seen now settle for a later run
+    cursor.execute("SELECT NOW(), COALESCE(MAX(id), 0) FROM HEAL_archive")
+    now, max_id = cursor.fetchone()
+    settled_id = last_id
+    if seen_at is None or (now - seen_at).total_seconds() >= lag_seconds:
+        settled_id = max(last_id, seen_id)
+        cursor.execute(
+            "INSERT INTO HEAL_rollup_state (name, last_id, seen_id, seen_at) VALUES (%s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE seen_id = VALUES(seen_id), seen_at = VALUES(seen_at)",
+            (state_name, last_id, max_id, now),
+        )
+        connection.commit()
+
+    rolled_up = 0
+    while last_id < settled_id:
+        cursor.execute("SELECT id, type, timestamp, module_ID, sub_module_name, message FROM HEAL_archive WHERE id > %s AND id <= %s ORDER BY id LIMIT %s",
+                       (last_id, settled_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        df = pd.DataFrame(rows, columns=archive_columns)
+        df["timestamp"] = pd.to_datetime(df["timestamp"])
+        for granularity in rollup_granularities:
+            frequency = bucket_frequencies[granularity]
+            upsert(cursor, upsert_storage_rollup.format(granularity=granularity), storage_summary(df, frequency))
+            upsert(cursor, upsert_status_rollup.format(granularity=granularity), status_summary(df, frequency))
+
+        last_id = int(df["id"].iloc[-1])
+        cursor.execute("INSERT INTO HEAL_rollup_state (name, last_id) VALUES (%s, %s) ON DUPLICATE KEY UPDATE last_id = VALUES(last_id)", (state_name, last_id))
+        connection.commit()
+        rolled_up += len(rows)
+
+    cursor.close()
+    # cached history queries may have read the rollups before these rows
+    if rolled_up:
+        invalidate_cache()
+    return rolled_up
+
+
+def main():
+    parser = argparse.ArgumentParser(description="maintain the hourly and daily HEAL_archive rollups")
+    parser.add_argument("--every", type=float, help="keep running, rolling up new rows every this many seconds")
+    parser.add_argument("--batch-size", type=int, default=batch_size)
+    args = parser.parse_args()
+
+    connection = mariadb.connect(**connection_params)
+    try:
+        while True:
+            started = time.perf_counter()
+            rolled_up = run_rollup(connection, args.batch_size)
+            print(f"rolled up {rolled_up} archive rows in {time.perf_counter() - started:.2f}s")
+            if not args.every:
+                break
+            time.sleep(args.every)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import argparse
+from datetime import date, timedelta
+import mariadb
+from data import service_checks
+from db import connection_params, dashboard_queries
+
+create_archive_table = """
+CREATE TABLE IF NOT EXISTS HEAL_archive (
+    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    type VARCHAR(16) NOT NULL,
+    timestamp DATETIME(3) NOT NULL,
+    module_ID VARCHAR(64) NOT NULL,
+    sub_module_name VARCHAR(128) NOT NULL,
+    line_number INT,
+    message VARCHAR(1024)
+)
+"""
+
+# composite indexes matching the equality + timestamp range filters of the dashboard queries,
+# plus timestamp alone so the date picker bounds are read from the ends of an index
+archive_indexes = {
+    "idx_sub_module_timestamp": "(sub_module_name, timestamp)",
+    "idx_module_timestamp": "(module_ID, timestamp)",
+    "idx_timestamp": "(timestamp)",
+}
+
+# how far archive.py has copied each log file into HEAL_archive, committed with the copied rows.
+# head holds the leading bytes so a file rewritten in place is recognised after a restart
+create_archive_checkpoint_table = """
+CREATE TABLE IF NOT EXISTS HEAL_archive_checkpoint (
+    file_path VARCHAR(512) NOT NULL PRIMARY KEY,
+    inode BIGINT UNSIGNED NOT NULL,
+    offset BIGINT UNSIGNED NOT NULL,
+    head VARBINARY(64) NOT NULL,
+    updated_at DATETIME NOT NULL
+)
+"""
+
+# hourly and daily summaries maintained by rollup.py, one pair of tables per summary
+rollup_granularities = ["hourly", "daily"]
+
+create_storage_rollup_table = """
+CREATE TABLE IF NOT EXISTS HEAL_storage_{granularity} (
+    disk VARCHAR(255) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    min_used_pct DOUBLE NOT NULL,
+    max_used_pct DOUBLE NOT NULL,
+    last_used_pct DOUBLE NOT NULL,
+    last_timestamp DATETIME(3) NOT NULL,
+    last_message VARCHAR(1024) NOT NULL,
+    PRIMARY KEY (disk, bucket_start),
+    KEY idx_bucket_start (bucket_start)
+)
+"""
+
+# target is the checked server for service checks and empty for every other sub module,
+# worst_level follows the DEBUG, INFO, WARNING, ERROR, CRITICAL order starting at 1
+create_status_rollup_table = """
+CREATE TABLE IF NOT EXISTS HEAL_status_{granularity} (
+    module_ID VARCHAR(64) NOT NULL,
+    sub_module_name VARCHAR(128) NOT NULL,
+    target VARCHAR(255) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    debug_count INT UNSIGNED NOT NULL,
+    info_count INT UNSIGNED NOT NULL,
+    warning_count INT UNSIGNED NOT NULL,
+    error_count INT UNSIGNED NOT NULL,
+    critical_count INT UNSIGNED NOT NULL,
+    worst_level TINYINT UNSIGNED NOT NULL,
+    PRIMARY KEY (module_ID, sub_module_name, target, bucket_start),
+    KEY idx_sub_module_bucket (sub_module_name, bucket_start)
+)
+"""
+
+# one serialized DDSketch of latencies per perf function and hour, merged to answer any range
+create_perf_sketch_table = """
+CREATE TABLE IF NOT EXISTS PERF_sketch (
+    module_ID VARCHAR(64) NOT NULL,
+    function_name VARCHAR(128) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    sample_count BIGINT UNSIGNED NOT NULL,
+    sketch BLOB NOT NULL,
+    PRIMARY KEY (module_ID, function_name, bucket_start)
+)
+"""
+
+# how far the perf worker has merged each perf log file into PERF_sketch, committed with the sketches
+create_perf_checkpoint_table = """
+CREATE TABLE IF NOT EXISTS PERF_sketch_checkpoint (
+    file_path VARCHAR(512) NOT NULL PRIMARY KEY,
+    inode BIGINT UNSIGNED NOT NULL,
+    offset BIGINT UNSIGNED NOT NULL,
+    head VARBINARY(64) NOT NULL,
+    updated_at DATETIME NOT NULL
+)
+"""
+
+# how far each rollup has read HEAL_archive, by archive id, and the highest id seen at
+# seen_at, which the next run may read up to once no insert can still commit below it
+create_rollup_state_table = """
+CREATE TABLE IF NOT EXISTS HEAL_rollup_state (
+    name VARCHAR(64) NOT NULL PRIMARY KEY,
+    last_id BIGINT UNSIGNED NOT NULL,
+    seen_id BIGINT UNSIGNED NOT NULL DEFAULT 0,
+    seen_at DATETIME NULL
+)
+"""
+# state tables created before seen_id was added
+rollup_state_columns = [
+    "seen_id BIGINT UNSIGNED NOT NULL DEFAULT 0",
+    "seen_at DATETIME NULL",
+]
+
+
+def migrate(connection):
+    cursor = connection.cursor()
+    cursor.execute(create_archive_table)
+    for name, columns in archive_indexes.items():
+        print(f"creating index {name} on HEAL_archive {columns}")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON HEAL_archive {columns}")
+    cursor.execute(create_archive_checkpoint_table)
+    for granularity in rollup_granularities:
+        print(f"creating rollup tables HEAL_storage_{granularity} and HEAL_status_{granularity}")
+        cursor.execute(create_storage_rollup_table.format(granularity=granularity))
+        cursor.execute(create_status_rollup_table.format(granularity=granularity))
+    cursor.execute(create_rollup_state_table)
+    for column in rollup_state_columns:
+        cursor.execute(f"ALTER TABLE HEAL_rollup_state ADD COLUMN IF NOT EXISTS {column}")
+    cursor.execute(create_perf_sketch_table)
+    cursor.execute(create_perf_checkpoint_table)
+    connection.commit()
+    cursor.close()
+
+
+# print the EXPLAIN plan of every query the dashboard runs
+def explain(connection, start_date, end_date, module_name, bucket_seconds=None):
+    cursor = connection.cursor()
+    for name, query, params in dashboard_queries(start_date, end_date, module_name, service_checks, bucket_seconds):
+        cursor.execute(f"EXPLAIN {query}", params)
+        columns = [column[0] for column in cursor.description]
+        print(f"-- {name}")
+        print(query)
+        for row in cursor.fetchall():
+            for column, value in zip(columns, row):
+                print(f"    {column}: {value}")
+        print()
+    cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HEAL_archive schema migration and query plans")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="create HEAL_archive and its indexes if missing")
+    explain_parser = subparsers.add_parser("explain", help="print EXPLAIN for each dashboard query")
+    explain_parser.add_argument("--from", dest="start_date", type=date.fromisoformat, default=date.today() - timedelta(days=30))
+    explain_parser.add_argument("--to", dest="end_date", type=date.fromisoformat, default=date.today())
+    explain_parser.add_argument("--module", default="HEAL_SR01")
+    explain_parser.add_argument("--bucket-seconds", type=int, help="explain the downsampled history queries")
+    args = parser.parse_args()
+
+    connection = mariadb.connect(**connection_params)
+    try:
+        if args.command == "migrate":
+            migrate(connection)
+        else:
+            explain(connection, args.start_date, args.end_date, args.module, args.bucket_seconds)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import math
+import struct
+import zlib
+import numpy as np
+
+# values closer to zero than this are counted in the zero bucket
+min_indexable_value = 1e-9
+header_format = "<dIqqddd"
+
+
+# DDSketch: a mergeable quantile sketch with a relative error guarantee.
+# Values are counted in logarithmically sized buckets, so any quantile is
+# returned within relative_accuracy of the true value while memory stays at
+# most max_bins buckets however many samples are added. Collapsing merges the
+# lowest buckets first, which keeps the upper percentiles accurate.
+class DDSketch:
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0.0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        positive = values[values > min_indexable_value]
+        self.zero_count += len(values) - len(positive)
+        indices, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("cannot merge sketches with different relative accuracy")
+        if other.count == 0:
+            return
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.collapse()
+
+    # fold the lowest buckets together until at most max_bins remain
+    def collapse(self):
+        if len(self.bins) <= self.max_bins:
+            return
+        indices = sorted(self.bins)
+        excess = len(indices) - self.max_bins + 1
+        target = indices[excess]
+        self.bins[target] += sum(self.bins.pop(index) for index in indices[:excess])
+
+    def quantile(self, q):
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_bytes(self):
+        indices = np.array(sorted(self.bins), dtype=np.int64)
+        counts = np.array([self.bins[index] for index in indices.tolist()], dtype=np.uint64)
+        header = struct.pack(header_format, self.relative_accuracy, self.max_bins, self.count, self.zero_count, self.min, self.max, self.sum)
+        # bucket indices are mostly consecutive, storing the gaps compresses well
+        gaps = np.diff(indices, prepend=0).astype(np.int32)
+        return zlib.compress(header + struct.pack("<I", len(indices)) + gaps.tobytes() + counts.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = zlib.decompress(data)
+        header_size = struct.calcsize(header_format)
+        relative_accuracy, max_bins, count, zero_count, minimum, maximum, total = struct.unpack_from(header_format, data)
+        (n_bins,) = struct.unpack_from("<I", data, header_size)
+        offset = header_size + 4
+        gaps = np.frombuffer(data, dtype=np.int32, count=n_bins, offset=offset)
+        counts = np.frombuffer(data, dtype=np.uint64, count=n_bins, offset=offset + 4 * n_bins)
+
+        sketch = cls(relative_accuracy, max_bins)
+        sketch.bins = dict(zip(np.cumsum(gaps, dtype=np.int64).tolist(), counts.tolist()))
+        sketch.count, sketch.zero_count = count, zero_count
+        sketch.min, sketch.max, sketch.sum = minimum, maximum, total
+        return sketch
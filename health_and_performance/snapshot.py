@@ -0,0 +1,105 @@
+import hashlib
+from collections import namedtuple
+from datetime import datetime
+from types import MappingProxyType
+
+# one row per hdd/service check result or plain sub module status;
+# key is server|hdd or the checked server, None for plain sub modules
+StatusEntry = namedtuple("StatusEntry", ["module_id", "sub_module_name", "key", "status", "storage"])
+
+
+def freeze_index(index):
+    return MappingProxyType({key: tuple(positions) for key, positions in index.items()})
+
+
+# Immutable, array-backed view of current_status. Modules, servers and entries are
+# stored in tuples with lookup indexes (sub module, server and latest entry per
+# disk) built once at publish time, and the content
+# hash is computed once too, so st.cache_data can key on it in O(1) instead of
+# hashing the whole nested structure on every call.
+class StatusSnapshot:
+    __slots__ = (
+        "version", "updated_at", "modules", "module_statuses", "servers", "server_statuses",
+        "entries", "content_hash", "sub_module_index", "server_index", "disk_index",
+    )
+
+    def __init__(self, version, updated_at, modules, module_statuses, servers, server_statuses, entries):
+        sub_module_index, disk_index = {}, {}
+        for position, entry in enumerate(entries):
+            sub_module_index.setdefault(entry.sub_module_name, []).append(position)
+            if entry.storage is not None:
+                # the latest check of a disk wins if several modules report it
+                disk_index[entry.key] = position
+
+        content = repr((modules, module_statuses, servers, server_statuses, entries)).encode()
+        values = {
+            "version": version,
+            "updated_at": updated_at,
+            "modules": tuple(modules),
+            "module_statuses": tuple(module_statuses),
+            "servers": tuple(servers),
+            "server_statuses": tuple(server_statuses),
+            "entries": tuple(entries),
+            "content_hash": hashlib.blake2b(content, digest_size=16).hexdigest(),
+            "sub_module_index": freeze_index(sub_module_index),
+            "server_index": MappingProxyType({server: position for position, server in enumerate(servers)}),
+            "disk_index": MappingProxyType(disk_index),
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("StatusSnapshot is immutable")
+
+    def __hash__(self):
+        return hash(self.content_hash)
+
+    def __eq__(self, other):
+        return isinstance(other, StatusSnapshot) and self.content_hash == other.content_hash
+
+    def __repr__(self):
+        return f"StatusSnapshot(version={self.version}, modules={len(self.modules)}, entries={len(self.entries)})"
+
+    @classmethod
+    def from_status(cls, version, status, updated_at=None):
+        servers = tuple(status["server"])
+        server_statuses = tuple(server["status"] for server in status["server"].values())
+        modules, module_statuses, entries = [], [], []
+        for module_id, module in status.items():
+            if module_id == "server":
+                continue
+            modules.append(module_id)
+            module_statuses.append(module["status"])
+            for sub_module_name, sub_module_info in module.items():
+                if sub_module_name == "status":
+                    continue
+                if isinstance(sub_module_info, dict):
+                    entries.append(StatusEntry(module_id, sub_module_name, None, sub_module_info["status"], None))
+                    continue
+                for check in sub_module_info:
+                    for key, result in check.items():
+                        entries.append(StatusEntry(module_id, sub_module_name, key, result["status"], result.get("storage")))
+        return cls(version, updated_at or datetime.now(), modules, module_statuses, servers, server_statuses, entries)
+
+    def get_server_status(self, server):
+        position = self.server_index.get(server)
+        return "INFO" if position is None else self.server_statuses[position]
+
+    def get_sub_module_entries(self, sub_module_name):
+        return tuple(self.entries[position] for position in self.sub_module_index.get(sub_module_name, ()))
+
+    def disks(self):
+        return tuple(self.disk_index)
+
+    # distinct partitions such as /dev/sda over every server's disks
+    def partitions(self):
+        return tuple(sorted({disk.split("|", 1)[-1] for disk in self.disk_index}))
+
+    # latest check_hdd entry of a server|hdd disk, None when it has not reported
+    def get_disk(self, disk):
+        position = self.disk_index.get(disk)
+        return None if position is None else self.entries[position]
+
+
+# st.cache_data hash_funcs entry so cached functions key on the precomputed hash
+snapshot_hash_funcs = {StatusSnapshot: lambda snapshot: snapshot.content_hash}
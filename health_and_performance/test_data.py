@@ -0,0 +1,96 @@
+import io
+import pandas as pd
+from data import LogTailer, column_names, init_default_dict, update_default_dict, upsert_entry, typed_log_frame, quiet_types, service_checks
+from loggen import write_heal_logs
+
+
+# the row by row aggregation update_default_dict replaced, kept as the reference it must match
+def reference_update(log_files_data, dictionary):
+    for df in log_files_data:
+        for row in df.itertuples(index=False):
+            alert = row.type not in quiet_types
+            module = dictionary.setdefault(row.module_id, {"status": "INFO"})
+            if alert:
+                module["status"] = row.type
+
+            if row.sub_module_name == "check_hdd":
+                server, hdd, used_space, available_space = row.message.split("|")
+                server_status = dictionary["server"].setdefault(server, {"status": "INFO"})
+                if alert:
+                    server_status["status"] = row.type
+                upsert_entry(module[row.sub_module_name], {f"{server}|{hdd}": {"status": row.type, "storage": f"{used_space}|{available_space}"}})
+            elif row.sub_module_name in service_checks:
+                server_status = dictionary["server"].setdefault(row.message, {"status": "INFO"})
+                if alert:
+                    server_status["status"] = row.type
+                upsert_entry(module[row.sub_module_name], {row.message: {"status": row.type}})
+            else:
+                module[row.sub_module_name] = {"status": row.type}
+    return dictionary
+
+
+def read_logs(folder):
+    log_files = write_heal_logs(str(folder), 20000, modules=6, servers=3, disks=2, days=2)
+    return [typed_log_frame(pd.read_csv(log_file, header=None, names=column_names)) for log_file in log_files]
+
+
+def test_update_default_dict_matches_row_by_row(tmp_path):
+    log_files_data = read_logs(tmp_path)
+    expected = reference_update(log_files_data, init_default_dict(log_files_data))
+    assert update_default_dict(log_files_data, init_default_dict(log_files_data)) == expected
+
+
+def test_update_default_dict_in_batches(tmp_path):
+    log_files_data = read_logs(tmp_path)
+    expected = reference_update(log_files_data, init_default_dict(log_files_data))
+    status = None
+    for df in log_files_data:
+        for start in range(0, len(df), 1500):
+            batch = [df.iloc[start:start + 1500]]
+            status = update_default_dict(batch, init_default_dict(batch, status))
+    assert status == expected
+
+
+# an append to an app log brings batches without a single check row
+def test_update_default_dict_without_check_rows():
+    line = '"WARNING","2024-03-04 13:16:23,451","HEAL_ET01","myfunc1","36","<message>"\n'
+    log_files_data = [typed_log_frame(pd.read_csv(io.StringIO(line), header=None, names=column_names))]
+    status = update_default_dict(log_files_data, init_default_dict(log_files_data))
+    assert status == {"server": {}, "HEAL_ET01": {"status": "WARNING", "myfunc1": {"status": "WARNING"}}}
+
+
+# a check_hdd message without server|hdd names no disk, its row is left out of the status
+def test_update_default_dict_skips_unreadable_disks():
+    lines = (
+        '"INFO","2024-03-04 13:16:23,451","HEAL_SR01","check_hdd","36","ip=10.0.0.3"\n'
+        '"INFO","2024-03-04 13:16:24,451","HEAL_SR01","check_hdd","36","ip=10.0.0.1|/dev/sda|10GB|30GB"\n'
+        '"INFO","2024-03-04 13:16:25,451","HEAL_SR01","check_db","40","ip=10.0.0.2"\n'
+    )
+    log_files_data = [typed_log_frame(pd.read_csv(io.StringIO(lines), header=None, names=column_names))]
+    status = update_default_dict(log_files_data, init_default_dict(log_files_data))
+    assert status == {
+        "server": {"ip=10.0.0.1": {"status": "INFO"}, "ip=10.0.0.2": {"status": "INFO"}},
+        "HEAL_SR01": {
+            "status": "INFO",
+            "check_hdd": [{"ip=10.0.0.1|/dev/sda": {"status": "INFO", "storage": "10GB|30GB"}}],
+            "check_db": [{"ip=10.0.0.2": {"status": "INFO"}}],
+        },
+    }
+
+
+# a malformed line is skipped, the lines around it and appended after it are still read
+def test_tailer_skips_malformed_lines(tmp_path):
+    log_file = tmp_path / "ET01.csv"
+    log_file.write_text(
+        '"INFO","2024-03-04 13:16:23,451","HEAL_ET01","myfunc1","36","<message>"\n'
+        '"INFO","2024-03-04 13:16:24,451","HEAL_ET01","myfunc1","36","<message>","extra"\n'
+        '"WARNING","2024-03-04 13:16:25,451","HEAL_ET01","myfunc2","40","<message>"\n'
+    )
+    tailer = LogTailer(str(tmp_path))
+    (df,) = tailer.read_new_logs()
+    assert df["sub_module_name"].tolist() == ["myfunc1", "myfunc2"]
+
+    with open(log_file, "a") as f:
+        f.write('"ERROR","2024-03-04 13:16:26,451","HEAL_ET01","myfunc3","44","<message>"\n')
+    (df,) = tailer.read_new_logs()
+    assert df["sub_module_name"].tolist() == ["myfunc3"]
@@ -0,0 +1,31 @@
+import numpy as np
+from forecast import DiskTrend, seconds_per_day
+
+# hourly checks over 60 days, filling half a percent a day
+seconds = np.arange(0, 60 * seconds_per_day, 3600.0)
+used_pct = 10 + seconds / seconds_per_day * 0.5
+
+
+# the decayed sums of checks fed in batches match those of the same checks fed at once
+def test_decay_matches_single_batch():
+    whole = DiskTrend(half_life_seconds=7 * seconds_per_day)
+    whole.update(seconds, used_pct)
+    batched = DiskTrend(half_life_seconds=7 * seconds_per_day)
+    for start in range(0, len(seconds), 50):
+        batched.update(seconds[start:start + 50], used_pct[start:start + 50])
+    assert np.allclose(batched.sums, whole.sums)
+
+
+# a backlog read in one batch still only counts the checks inside the window,
+# the same ones as when the checks arrive in many batches
+def test_window_slides_within_one_batch():
+    window_seconds = 7 * seconds_per_day
+    whole = DiskTrend(window_seconds=window_seconds)
+    whole.update(seconds, used_pct)
+    batched = DiskTrend(window_seconds=window_seconds)
+    for start in range(0, len(seconds), 50):
+        batched.update(seconds[start:start + 50], used_pct[start:start + 50])
+    # the window's oldest bucket is only partly inside it
+    assert 7 * 24 <= whole.points <= 8 * 24
+    assert whole.points == batched.points
+    assert np.allclose(batched.sums, whole.sums)
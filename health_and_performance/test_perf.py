@@ -0,0 +1,53 @@
+import pandas as pd
+import pytest
+
+# perf.py saves through db.py
+pytest.importorskip("mariadb")
+
+from perf import PerfStats, perf_column_names, get_perf_data
+from sketch import DDSketch
+
+
+def perf_frame(hours, function="poller"):
+    rows = [["INFO", f"2024-03-{1 + hour // 24:02d} {hour % 24:02d}:15:00", "451", "PERF_SR01", function, "286", f"time={hour + 1}ms"]
+            for hour in hours]
+    return pd.DataFrame(rows, columns=perf_column_names)
+
+
+# a backlog longer than the buckets kept in memory is still saved whole
+def test_evicted_buckets_are_saved():
+    stats = PerfStats(retained_buckets=4)
+    stats.update(get_perf_data([perf_frame(range(10))]))
+    assert len(stats.functions[("PERF_SR01", "poller")]["sketches"]) == 4
+    rows = stats.pop_unsaved_sketches()
+    assert len(rows) == 10
+    assert stats.pop_unsaved_sketches() == []
+
+
+# only samples added since the last save are handed out, so they can be merged into the stored sketch
+def test_unsaved_sketches_hold_new_samples_only():
+    stats = PerfStats()
+    stats.update(get_perf_data([perf_frame([0, 0])]))
+    stats.pop_unsaved_sketches()
+    stats.update(get_perf_data([perf_frame([0])]))
+    (row,) = stats.pop_unsaved_sketches()
+    assert row[3] == 1
+    assert DDSketch.from_bytes(row[4]).count == 1
+    assert stats.functions[("PERF_SR01", "poller")]["sketches"][row[2]].count == 3
+
+
+def test_restored_rows_merge_with_newer_samples():
+    stats = PerfStats()
+    stats.update(get_perf_data([perf_frame([0])]))
+    rows = stats.pop_unsaved_sketches()
+    stats.update(get_perf_data([perf_frame([0])]))
+    stats.restore_unsaved(rows)
+    (row,) = stats.pop_unsaved_sketches()
+    assert row[3] == 2
+
+
+def test_saved_samples_are_not_saved_again():
+    stats = PerfStats()
+    stats.update(get_perf_data([perf_frame([0, 1])]), save=False)
+    assert stats.pop_unsaved_sketches() == []
+    assert stats.summary()[("PERF_SR01", "poller")]["count"] == 2
@@ -0,0 +1,28 @@
+import pandas as pd
+from matplotlib import pyplot as plt
+import instrument
+import render
+
+
+def draw_line(values):
+    fig, ax = plt.subplots()
+    ax.plot(values)
+    return fig, len(values)
+
+
+def test_render_cache_stats_are_written_as_samples(tmp_path, monkeypatch):
+    samples_file = tmp_path / "dashboard.csv"
+    monkeypatch.setattr(instrument, "enabled", True)
+    monkeypatch.setattr(instrument, "samples_file", str(samples_file))
+    monkeypatch.setattr(instrument, "flush_seconds", 0)
+    monkeypatch.setattr(render, "render_cache", render.RenderCache())
+
+    png, extra = render.render_png(draw_line, [1, 2, 3])
+    assert render.render_png(draw_line, [1, 2, 3]) == (png, extra)
+    render.render_png(draw_line, [3, 2, 1])
+
+    assert render.render_cache.stats() == {"hits": 1, "misses": 2, "entries": 2, "size_bytes": render.render_cache.size_bytes}
+    samples = pd.read_csv(samples_file, header=None)
+    cache_samples = samples[samples[4] == "render.cache"][6].tolist()
+    assert len(cache_samples) == 2
+    assert cache_samples[-1].endswith(f"hits=1 misses=2 entries=2 size_bytes={render.render_cache.size_bytes}")
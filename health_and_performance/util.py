@@ -1,66 +1,82 @@
-import re
+import math
 import streamlit as st
 import numpy as np
-from datetime import datetime
-
-# get numerical value from storage represented by units i.e 70 from 70gb
-def extract_numeric(storage_string):
-    numerical_value = re.search(r'\d+', storage_string)
-    if numerical_value:
-        return float(numerical_value.group())
-    else:
-        return None
-
-
-@st.cache_data()
-def get_hdd_storage(current_status):
-    hdds_storage = []
-    for _, sub_module in current_status.items():
-        for sub_module, sub_module_info in sub_module.items():
-            if "check_hdd" in sub_module:
-                hdd_info = sub_module_info
-
-                for hdd in hdd_info:
-                    for disk, data in hdd.items():
-                        storage = data["storage"]
-                        hdd_storage = list(map(extract_numeric, storage.split("|")))
-                        hdds_storage.append(hdd_storage)
-    return hdds_storage                  
-
-
-def get_services_status(current_status, service):
-    for module, sub_module in current_status.items():
-        for sub_module, sub_module_info in sub_module.items():
-            if service in sub_module:
-                return sub_module_info
-                
-
-@st.cache_data()
-def get_module_status(current_status):
-    module_status = [{module: sub_module["status"]} for module, sub_module in current_status.items() if module != "server"]
+import pandas as pd
+from datetime import timedelta
+from snapshot import snapshot_hash_funcs
+from instrument import timed, track_cache
+
+# finest history bucket worth asking the database for, checks run about once a minute
+min_bucket_seconds = 60
+
+# bytes per storage unit, sizes logged without a unit are taken as gb like the rest of the check_hdd messages
+storage_units = {"b": 1, "kb": 1024, "mb": 1024**2, "gb": 1024**3, "tb": 1024**4, "pb": 1024**5}
+default_storage_unit = "gb"
+size_pattern = r"^\s*(\d+(?:\.\d+)?)\s*([kmgtp]?b)?\s*$"
+
+
+# sizes such as 70gb or 1.5TB to bytes, NaN when a size cannot be read
+def parse_sizes(sizes):
+    parts = sizes.str.lower().str.extract(size_pattern)
+    units = parts[1].fillna(default_storage_unit).map(storage_units)
+    return parts[0].astype(float) * units.astype(float)
+
+
+# Parse check_hdd messages (server|partition|used|available) into typed columns
+# with column operations: server, partition, used_bytes, available_bytes and used_pct.
+# Messages repeat a lot, so each distinct message is only parsed once.
+def parse_hdd_messages(messages):
+    messages = pd.Series(messages, dtype=object).fillna("")
+    codes, uniques = pd.factorize(messages)
+    parts = pd.Series(uniques, dtype=object).str.split("|", n=3, expand=True).reindex(columns=range(4))
+    used = parse_sizes(parts[2])
+    available = parse_sizes(parts[3])
+    parsed = pd.DataFrame({
+        "server": parts[0],
+        "partition": parts[1],
+        "used_bytes": used,
+        "available_bytes": available,
+        "used_pct": (used / (used + available) * 100).round(2),
+    })
+    parsed = parsed.take(codes)
+    parsed.index = messages.index
+    return parsed
+
+
+# used and available space in gb per server|hdd disk, disks whose latest check has
+# unreadable sizes or a total of 0 are left out
+@track_cache("util.get_hdd_storage", st.cache_data(hash_funcs=snapshot_hash_funcs))
+def get_hdd_storage(status_snapshot):
+    disks = status_snapshot.disks()
+    messages = [f"{disk}|{status_snapshot.get_disk(disk).storage}" for disk in disks]
+    parsed = parse_hdd_messages(messages)
+    storage = parsed[["used_bytes", "available_bytes"]] / storage_units["gb"]
+    total = storage["used_bytes"] + storage["available_bytes"]
+    valid = (np.isfinite(total) & (total > 0)).to_numpy()
+    return {disk: sizes for disk, sizes, keep in zip(disks, storage.values.tolist(), valid) if keep}
+
+
+# entries of a service check such as check_db, looked up by name in the snapshot's index
+def get_services_status(status_snapshot, service):
+    return status_snapshot.get_sub_module_entries(service)
+
+
+@track_cache("util.get_module_status", st.cache_data(hash_funcs=snapshot_hash_funcs))
+def get_module_status(status_snapshot):
+    module_status = [{module: status} for module, status in zip(status_snapshot.modules, status_snapshot.module_statuses)]
     return module_status
 
 
-def get_date_range(connection):
-    cursor = connection.cursor()
-    cursor.execute("SELECT MIN(DATE(timestamp)), MAX(DATE(timestamp)) FROM HEAL_archive;")
-    minmax_dates = cursor.fetchall()
-    earliest_date, latest_date = minmax_dates[0]
-    cursor.close()
-    return earliest_date, latest_date
-
-
-@st.cache_data()
+# options are passed as tuples and never modified, the "All" entry is skipped instead of removed
+@track_cache("util.selected_hdd", st.cache_data())
 def selected_hdd(server, partition, server_options, partition_options):
     if server == "All":
-        server_options.remove("All")
-        selected_servers = [server.replace("Server 1", "ip=10.0.0.1") if server == "Server 1" else server.replace("Server 2", "ip=10.0.0.2") for server in server_options]
+        selected_servers = [server for server in server_options if server != "All"]
     else:
-        selected_servers = [server.replace("Server 1", "ip=10.0.0.1") if server == "Server 1" else server.replace("Server 2", "ip=10.0.0.2")]
-    
+        selected_servers = [server]
+
     if partition == "All":
-        partition_options.remove("All")
-        selected_partitions = partition_options
+        selected_partitions = [partition for partition in partition_options if partition != "All"]
     else:
         selected_partitions = [partition]
 
@@ -73,64 +89,114 @@ def selected_hdd(server, partition, server_options, partition_options):
     return selected_hdds
 
 
-@st.cache_data()
-def get_storage_history(all_storage_history, selected_hdds):
+# Size of the time buckets history is grouped into so a chart gets roughly one
+# bucket per two pixels across its width. None when the range is short enough
+# that raw rows are already fewer than that.
+def history_bucket_seconds(start_date, end_date, width_px):
+    span_seconds = (end_date + timedelta(days=1) - start_date).total_seconds()
+    bucket_seconds = math.ceil(span_seconds / max(width_px // 2, 1))
+    if bucket_seconds <= min_bucket_seconds:
+        return None
+    return bucket_seconds
+
+
+# Largest-Triangle-Three-Buckets: indices of at most `threshold` points that keep
+# the visual shape of the series, always including the first and last point
+def lttb(x_values, y_values, threshold):
+    n = len(x_values)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    x_values = np.asarray(x_values, dtype=float)
+    y_values = np.asarray(y_values, dtype=float)
+    bucket_size = (n - 2) / (threshold - 2)
+    selected = np.empty(threshold, dtype=np.intp)
+    selected[0], selected[-1] = 0, n - 1
+
+    previous = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        average_x = x_values[end:next_end].mean()
+        average_y = y_values[end:next_end].mean()
+
+        # pick the point forming the largest triangle with the previous pick and the next bucket's average
+        areas = np.abs(
+            (x_values[previous] - average_x) * (y_values[start:end] - y_values[previous])
+            - (x_values[previous] - x_values[start:end]) * (average_y - y_values[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+
+# not wrapped in st.cache_data: hashing the fetched rows for the cache key costs far more
+# than parsing them, and the rows themselves are already cached by db.fetch_all
+@timed("util.get_storage_history")
+def get_storage_history(all_storage_history, selected_hdds, max_points=None):
     storage_history_data = {}
-    for storage_history in all_storage_history:
-        timestamp, hdd_storage_info = storage_history
-        server_ip, partition, used, available = hdd_storage_info.split("|")
-        
-        hdd = f"{server_ip}|{partition}"
-
-        if hdd in selected_hdds:
-            used, available = list(map(extract_numeric, [used, available]))
-            used_storage = round(used/(used+available)*100, 2)
-
-            if hdd not in storage_history_data:
-                storage_history_data[hdd] = {"datetime": [], "storage_used": []}
-
-            storage_history_data[hdd]["datetime"].append(timestamp)
-            storage_history_data[hdd]["storage_used"].append(used_storage)
+    if not all_storage_history:
+        return storage_history_data
+
+    timestamps = np.empty(len(all_storage_history), dtype=object)
+    timestamps[:] = [timestamp for timestamp, _ in all_storage_history]
+    parsed = parse_hdd_messages([message for _, message in all_storage_history])
+    parsed.index = range(len(parsed))
+
+    hdds = parsed["server"] + "|" + parsed["partition"]
+    selected = parsed.loc[hdds.isin(selected_hdds)]
+    for hdd, history in selected.groupby(hdds[selected.index], sort=False):
+        storage_history_data[hdd] = {
+            "datetime": timestamps[history.index].tolist(),
+            "storage_used": history["used_pct"].tolist(),
+        }
+
+    # keep each line within the chart's pixel budget
+    if max_points:
+        for hdd, history in storage_history_data.items():
+            timestamps = pd.DatetimeIndex(history["datetime"]).asi8
+            keep = lttb(timestamps, history["storage_used"], max_points)
+            storage_history_data[hdd] = {
+                "datetime": [history["datetime"][i] for i in keep],
+                "storage_used": [history["storage_used"][i] for i in keep],
+            }
 
     return storage_history_data
 
 
-def predict_full(x_values, y_values):
-
-    timestamps = np.array([dt.timestamp() for dt in x_values])
-
-    gradient, intercept = np.polyfit(timestamps, y_values, deg=1)
-    full_storage = 100.0
-    date_timestamp = ((full_storage - intercept)/gradient)
-    date = datetime.fromtimestamp(date_timestamp)
-    return date
-
-#x = [datetime(2024, 2, 29, 13, 16, 23), datetime(2024, 3, 1, 13, 16, 23), datetime(2024, 3, 2, 13, 16, 23), datetime(2024, 3, 3, 13, 16, 23), datetime(2024, 3, 4, 13, 16, 23)]
-#y = [15, 16.05, 17.5, 18.65, 20]
-#
-#date = predict_full(x, y)
-#print(date)
-
-
+# Compress each service's status checks into runs of constant status.
+# A run lasts from its first check until the first check of the next run,
+# the last run ends at the latest check.
+@timed("util.get_services_history")
 def get_services_history(services_status_history):
     data = {}
     for service_history in services_status_history:
         msg, timestamp, service_func, server_ip =  service_history
 
-        key = f"{service_func}|{server_ip}" if service_func == "check_db" else service_func
+        # every server a service is checked on gets its own row
+        key = f"{service_func}|{server_ip}"
 
         if key not in data:
-            data[key] = {"dates": [], "status_type": []}
-
-        data[key]["dates"].append(timestamp)
-        data[key]["status_type"].append(msg)
+            data[key] = {"start": [], "end": [], "status_type": []}
+
+        runs = data[key]
+        if runs["status_type"] and runs["status_type"][-1] == msg:
+            runs["end"][-1] = timestamp
+            continue
+
+        if runs["end"]:
+            runs["end"][-1] = timestamp
+        runs["start"].append(timestamp)
+        runs["end"].append(timestamp)
+        runs["status_type"].append(msg)
     return data
 
 
-def get_service_func(selected_services, services_name_w_func):
-    selected_service_func = []
-    for selected_service in selected_services:
-        for s_name, s_func in services_name_w_func:
-            if selected_service == s_name:
-                selected_service_func.append((s_func))
-    return selected_service_func
\ No newline at end of file
+# "MariaDB (ip=10.0.0.1)" for every service|server key, service_names maps checks to display names
+def service_labels(keys, service_names):
+    labels = {}
+    for key in keys:
+        service_func, server = key.split("|", 1)
+        labels[key] = f"{service_names.get(service_func, service_func)} ({server})"
+    return labels
@@ -1,39 +1,60 @@
+import base64
+import math
+from functools import lru_cache
 from matplotlib import pyplot as plt
-import matplotlib.image as mpimg
 import matplotlib.lines as mlines
+import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
 import mplcursors
 import streamlit as st
-from datetime import datetime
 import numpy as np
+from instrument import timed, track_cache
+
+# size of the history graphs, the downsampling budget is derived from their pixel width
+graph_figsize = (8, 4)
+graph_dpi = 100
+graph_width_px = graph_figsize[0] * graph_dpi
+# markers only help while individual points can still be told apart
+max_marked_points = 60
+
+# storage gauges are cached per step of used percentage rather than per exact value
+gauge_step = 0.5
+gauge_radius = 40
+gauge_circumference = 2 * math.pi * gauge_radius
+
+
+# hdd icons are read from disk once and embedded as data uris
+@lru_cache(maxsize=None)
+def load_icon(name):
+    with open(f"./icons/{name}.png", "rb") as f:
+        return "data:image/png;base64," + base64.b64encode(f.read()).decode()
+
+
+@lru_cache(maxsize=256)
+def storage_gauge_html(used_percent):
+    color = "green" if used_percent <= 60 else "orange" if used_percent < 80 else "red"
+    used_length = gauge_circumference * used_percent / 100
+    return f"""
+        <div style="text-align: center;">
+            <svg viewBox="0 0 100 100" style="width: 100%; max-width: 120px;">
+                <circle cx="50" cy="50" r="{gauge_radius}" fill="none" stroke="#66b3ff" stroke-width="10"/>
+                <circle cx="50" cy="50" r="{gauge_radius}" fill="none" stroke="#ff8080" stroke-width="10"
+                    stroke-dasharray="{used_length:.2f} {gauge_circumference:.2f}" transform="rotate(-90 50 50)"/>
+                <image href="{load_icon(f'icons8-server-storage-48-{color}')}" x="30" y="30" width="40" height="40"/>
+            </svg>
+            <div style="color: #FAFAFA; font-weight: 700;">{used_percent:.1f}%</div>
+        </div>
+    """
 
-# Hdd storage stats
-@st.cache_data(show_spinner=True)
-def draw_donut_chart(used, remaining):
-    sizes = [used, remaining]
-    colors = ['#ff8080', '#66b3ff']
-
-    fig2, ax2 = plt.subplots(figsize=(1, 1), dpi=10, facecolor="#002B36")
-    ax2.pie(sizes, colors=colors, startangle=90, autopct='%1.2f%%', textprops={'color': "#FAFAFA", "fontsize": 12, "fontweight": 700}, wedgeprops=dict(width=0.25), pctdistance=0.7)
-    ax2.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
-
-    # Draw a  circle in the center to create the donut chart
-    centre_circle = plt.Circle((0, 0), 0.8, color=(0/255, 43/255, 54/255), alpha=0.1)  # Transparent background
-    ax2.add_artist(centre_circle)
-
-    # Load the hard disk icon image
-    color = "green" if used/(used+remaining) <= 0.6 else "orange" if 0.6 < used/(used+remaining) < 0.8 else "red"
-    hdd_icon = mpimg.imread(f"./icons/icons8-server-storage-48-{color}.png")  # Replace with the path to your HDD icon image
-
-    # Plot the hard disk icon within the donut chart
-    ax2.imshow(hdd_icon, extent=(-0.4, 0.4, -0.4, 0.4), aspect='equal', zorder=1)
-
-    # Hide axes
-    ax2.axis('off')
 
-    return fig2
+# Hdd storage stats as an svg donut, no matplotlib figure or disk read per rerun
+def draw_storage_gauge(used, remaining):
+    # util.get_hdd_storage leaves out disks whose sizes could not be read
+    used_percent = used / (used + remaining) * 100
+    return storage_gauge_html(round(used_percent / gauge_step) * gauge_step)
 
 
-@st.cache_data()
+@track_cache("visualisation.status_indicator", st.cache_data())
 def status_indicator(status):
     color = "#FF6347" if status in ["ERROR", "CRITICAL"] else "#FFA500" if status == "WARNING" else "#32CD32"
     statusHTML =f"""
@@ -42,7 +63,7 @@ def status_indicator(status):
     return statusHTML
 
 
-@st.cache_data()
+@track_cache("visualisation.create_module", st.cache_data())
 def create_module(module_name, status):
     color = "red" if status in ["ERROR", "CRITICAL"] else "orange" if status == "WARNING" else "green"
     moduleHTML = f"""
@@ -53,35 +74,17 @@ def create_module(module_name, status):
     return moduleHTML
 
 
-def predict_full(x_values, y_values):
-
-    timestamps = np.array([dt.timestamp() for dt in x_values])
-
-    gradient, intercept = np.polyfit(timestamps, y_values, deg=1)
-    full_storage = 100.0
-    date_timestamp = ((full_storage - intercept)/gradient)
-    date = datetime.fromtimestamp(date_timestamp)
-    
-    storage_delta = y_values[-1] - y_values[-2]
-
-    return date, storage_delta
-
-
-@st.cache_data()
+# rendered and cached as png by render.render_png, which also closes the figure
+@timed("visualisation.draw_storage_graph")
 def draw_storage_graph(storage_data):
     with plt.style.context('Solarize_Light2'):
-        fig, ax = plt.subplots(figsize=(8, 4))
+        fig, ax = plt.subplots(figsize=graph_figsize, dpi=graph_dpi)
 
-        storage_metrics = {}
         for hdd, storage_info in storage_data.items():
-            ax.plot(storage_info["datetime"], storage_info["storage_used"], label=hdd, linewidth=2, marker="o", markersize=5)
+            marker = "o" if len(storage_info["datetime"]) <= max_marked_points else None
+            ax.plot(storage_info["datetime"], storage_info["storage_used"], label=hdd, linewidth=2, marker=marker, markersize=5)
             ax.fill_between(storage_info["datetime"], storage_info["storage_used"], alpha=0.4)
 
-            # extrapolating the graph based on data to determine estimated date od full capacity
-            full_storage_date, storage_delta = predict_full(storage_info["datetime"], storage_info["storage_used"])
-            if hdd not in storage_metrics:
-                storage_metrics[hdd] = {"date": full_storage_date, "storage_delta": round(storage_delta, 2)}
-
         ax.set_title("Hard Disk Storage", color="#FAFAFA")
         ax.set_xlabel("Date", color="#FAFAFA")
         ax.set_ylabel("Storage (%)", color="#FAFAFA", rotation=0)
@@ -97,52 +100,63 @@ def draw_storage_graph(storage_data):
         fig.set_facecolor("#002b36")
         ax.xaxis.set_label_coords(0.98, 0.06)
         ax.yaxis.set_label_coords(0.00, 1.05)
-    return fig, storage_metrics
+    return fig
+
 
+def status_color(status_type):
+    return '#FF6347' if status_type in ["CRITICAL", "ERROR"] else '#FFA500' if status_type == "WARNING" else '#32CD32'
 
-@st.cache_data()
-def draw_service_status_graph(data, selected_service_func):
+
+# rendered and cached as png by render.render_png, which also closes the figure
+@timed("visualisation.draw_service_status_graph")
+def draw_service_status_graph(data, selected_labels):
     with plt.style.context('Solarize_Light2'):
             
         # Create a figure and axis
-        fig, ax = plt.subplots(figsize=(8, 4))
-
-        for service_func, service_status_hist in data.items():
-            if service_func in selected_service_func:
-                x_values = service_status_hist["dates"]
-                y_values = [0] * len(x_values)
-
-                # Plot the horizontal line segment by segment
-                for i in range(len(x_values) - 1):
-                    start_date = x_values[i]
-                    end_date = x_values[i + 1]
-                    status_type = service_status_hist['status_type'][i]
-                    
-                    # Set color based on status type
-                    color = '#FF6347' if status_type in ["CRITICAL", "ERROR"] else '#FFA500' if status_type == "WARNING" else '#32CD32'
-
-                    # legend labels
-                    green_line = mlines.Line2D([], [], color='#32CD32', marker='|', markersize=8, linewidth=5, label="INFO/DEBUG")
-                    red_line = mlines.Line2D([], [], color='#FF6347', marker='|', markersize=8, linewidth=5, label="ERROR/CRITICAL")
-                    orange_line = mlines.Line2D([], [], color='#FFA500', marker='|', markersize=8, linewidth=5, label="WARNING")
-
-                    # Plot line segment
-                    ax.plot([start_date, end_date], [f"{service_func}", f"{service_func}"], color=color, linewidth=5, marker="|", markersize=8, solid_capstyle="round")
-
-                # Add labels and title
-                ax.set_xlabel('Date', color="#FAFAFA")
-                ax.set_ylabel('Services',color="#FAFAFA", rotation = 0)
-                ax.set_title('Status History', color="#FAFAFA")      
-                ax.grid(color='#586e75', linestyle='-', linewidth=0.25, alpha=0.7)
-                ax.spines['top'].set_visible(False)
-                ax.spines['right'].set_visible(False)
-                ax.legend(handles=[green_line, orange_line, red_line], fontsize=7, framealpha=0.5, bbox_to_anchor=(0, -0.025))
-
-                fig.autofmt_xdate(rotation=45)
-                ax.set_facecolor("#002b36")
-                fig.set_facecolor("#002b36")
-                ax.xaxis.set_label_coords(0.98, 0.06)
-                ax.yaxis.set_label_coords(0.00, 1.05)   
+        fig, ax = plt.subplots(figsize=graph_figsize, dpi=graph_dpi)
+
+        selected = [key for key in data if key in selected_labels]
+
+        # one horizontal segment per run of constant status, all services drawn in a single collection
+        segments, colors = [], []
+        for row, key in enumerate(selected):
+            runs = data[key]
+            starts = mdates.date2num(runs["start"])
+            ends = mdates.date2num(runs["end"])
+            rows = np.full(len(starts), row)
+            segments.append(np.stack([np.column_stack([starts, rows]), np.column_stack([ends, rows])], axis=1))
+            colors.extend(status_color(status_type) for status_type in runs["status_type"])
+
+        if segments:
+            segments = np.concatenate(segments)
+            ax.add_collection(LineCollection(segments, colors=colors, linewidths=5, capstyle="round"))
+            # mark where the status changes while runs are few enough to tell apart
+            if len(segments) <= max_marked_points:
+                ax.scatter(segments[:, 0, 0], segments[:, 0, 1], marker="|", s=64, c=colors, zorder=3)
+            ax.autoscale_view()
+        ax.xaxis_date()
+        ax.set_yticks(range(len(selected)), labels=[selected_labels[key] for key in selected])
+        ax.set_ylim(-0.5, len(selected) - 0.5)
+
+        # legend labels
+        green_line = mlines.Line2D([], [], color='#32CD32', marker='|', markersize=8, linewidth=5, label="INFO/DEBUG")
+        red_line = mlines.Line2D([], [], color='#FF6347', marker='|', markersize=8, linewidth=5, label="ERROR/CRITICAL")
+        orange_line = mlines.Line2D([], [], color='#FFA500', marker='|', markersize=8, linewidth=5, label="WARNING")
+
+        # Add labels and title
+        ax.set_xlabel('Date', color="#FAFAFA")
+        ax.set_ylabel('Services',color="#FAFAFA", rotation = 0)
+        ax.set_title('Status History', color="#FAFAFA")      
+        ax.grid(color='#586e75', linestyle='-', linewidth=0.25, alpha=0.7)
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.legend(handles=[green_line, orange_line, red_line], fontsize=7, framealpha=0.5, bbox_to_anchor=(0, -0.025))
+
+        fig.autofmt_xdate(rotation=45)
+        ax.set_facecolor("#002b36")
+        fig.set_facecolor("#002b36")
+        ax.xaxis.set_label_coords(0.98, 0.06)
+        ax.yaxis.set_label_coords(0.00, 1.05)   
     return fig
 
 
@@ -0,0 +1,95 @@
+import logging
+import os
+from threading import Thread, Event
+from data import get_new_logs
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+logger = logging.getLogger(__name__)
+
+# how often the fallback compares the log files when watchdog is not installed
+scan_seconds = 1
+# only changes to the contents count, the tailers opening and reading the files must not wake them again
+change_events = {"created", "modified", "moved", "deleted"}
+
+
+# watchdog hands every filesystem event to dispatch
+class ChangeHandler:
+    def __init__(self, changed):
+        self.changed = changed
+
+    def dispatch(self, event):
+        if event.is_directory or event.event_type not in change_events:
+            return
+        self.changed(os.fsdecode(event.src_path))
+        if getattr(event, "dest_path", None):
+            self.changed(os.fsdecode(event.dest_path))
+
+
+# Calls on_change(path) whenever a csv log in folder_path is created, appended to,
+# rotated or deleted. Uses watchdog, i.e. inotify on linux, when it is installed and
+# otherwise compares the inode, size and mtime of every log file each scan_seconds.
+class LogWatcher:
+    def __init__(self, folder_path, on_change, scan_seconds=scan_seconds, use_watchdog=True):
+        self.folder_path = folder_path
+        self.on_change = on_change
+        self.scan_seconds = scan_seconds
+        self.use_watchdog = use_watchdog and Observer is not None
+        self.observer = None
+        self.thread = None
+        self.stop_event = Event()
+
+    def start(self):
+        if self.use_watchdog:
+            try:
+                observer = Observer()
+                observer.schedule(ChangeHandler(self.changed), self.folder_path, recursive=False)
+                observer.start()
+                self.observer = observer
+                return self
+            except OSError:
+                # e.g. out of inotify watches
+                logger.exception("cannot watch %s for changes, scanning it instead", self.folder_path)
+
+        self.thread = Thread(target=self.scan, name=f"log-watcher-{os.path.basename(self.folder_path)}", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.observer is not None:
+            self.observer.stop()
+
+    def changed(self, path):
+        if not path.endswith(".csv"):
+            return
+        try:
+            self.on_change(path)
+        except Exception:
+            logger.exception("log watcher callback failed for %s", path)
+
+    def file_states(self):
+        states = {}
+        for log_file in get_new_logs(self.folder_path):
+            try:
+                stat = os.stat(log_file)
+            except FileNotFoundError:
+                continue
+            states[log_file] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        return states
+
+    def scan(self):
+        states = self.file_states()
+        while not self.stop_event.wait(self.scan_seconds):
+            try:
+                current = self.file_states()
+            except OSError:
+                logger.exception("failed to scan %s for changes", self.folder_path)
+                continue
+            for log_file in states.keys() | current.keys():
+                if states.get(log_file) != current.get(log_file):
+                    self.changed(log_file)
+            states = current
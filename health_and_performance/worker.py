@@ -0,0 +1,265 @@
+import logging
+import time
+from collections import namedtuple
+from datetime import datetime
+from threading import Thread, Event, RLock
+import mariadb
+import streamlit as st
+from archive import ArchiveWriter, BatchArchiver, archive_enabled, connect
+from data import LogTailer, init_default_dict, update_default_dict, typed_log_frame, folder_path, parse_workers
+from forecast import CapacityForecaster
+from instrument import timed, write_sample
+from logcache import LogCache
+from perf import PerfStats, get_perf_data, get_perf_checkpoints, perf_column_names, perf_folder_path, read_saved_ranges, save_sketches
+from receiver import LogReceiver, receiver_enabled
+from rollup import run_rollup
+from snapshot import StatusSnapshot
+from watcher import LogWatcher
+
+logger = logging.getLogger(__name__)
+
+# how often the background thread looks for appended log lines when no watcher wakes it
+poll_seconds = 60
+# lines are usually appended in bursts, a woken worker waits this long so one ingest takes the whole burst
+settle_seconds = 0.2
+
+# Published perf statistics. The worker never mutates a snapshot after publishing it,
+# it builds a new one, so readers can hold on to it without locking.
+PerfSnapshot = namedtuple("PerfSnapshot", ["version", "updated_at", "latencies"])
+
+
+# Calls ingest() on a daemon thread until stopped, whenever wake() is called and at
+# least every poll_seconds. A LogWatcher on the tailed folder calls wake() on changes.
+class PollingWorker(Thread):
+    def __init__(self, name, tailer, poll_seconds=poll_seconds):
+        super().__init__(name=name, daemon=True)
+        self.tailer = tailer
+        self.poll_seconds = poll_seconds
+        self.stop_event = Event()
+        self.wake_event = Event()
+        # reentrant so ingest can hand what it read to apply
+        self.ingest_lock = RLock()
+        self.watcher = None
+
+    def snapshot(self):
+        return self.current
+
+    def ingest(self):
+        raise NotImplementedError
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.ingest()
+            except Exception:
+                logger.exception("%s failed to ingest %s", self.name, self.tailer.folder_path)
+            # a wake during the ingest above is kept, its lines may have been missed
+            if self.wake_event.wait(self.poll_seconds):
+                self.stop_event.wait(settle_seconds)
+            self.wake_event.clear()
+
+    def wake(self, path=None):
+        self.wake_event.set()
+
+    # wake on every change to the tailed folder instead of waiting for the next poll
+    def watch(self):
+        self.watcher = LogWatcher(self.tailer.folder_path, self.wake).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.watcher is not None:
+            self.watcher.stop()
+
+
+# Tails the log folder on a background thread and publishes a new snapshot
+# whenever lines are appended. One worker is shared by every session.
+# Parsed rows are kept in a parquet cache so a restart only parses new lines.
+class StatusWorker(PollingWorker):
+    def __init__(self, folder_path, poll_seconds=poll_seconds, cache=None, workers=parse_workers):
+        super().__init__("status-worker", LogTailer(folder_path, parse=typed_log_frame, workers=workers), poll_seconds)
+        self.cache = cache if cache is not None else LogCache()
+        # rows restored from the cache, handed to the first ingest
+        self.cached_data = self.cache.load(self.tailer)
+        # callables given the newly parsed frames after every ingest, e.g. archival
+        self.listeners = []
+        # working copy only the worker touches, readers get immutable StatusSnapshots of it
+        self.status = init_default_dict([])
+        self.current = StatusSnapshot.from_status(0, self.status)
+        # capacity forecast per disk, replaced as a whole after every ingest
+        self.forecaster = CapacityForecaster()
+        self.forecasts = {}
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # read appended lines and publish a new snapshot, returns whether anything changed
+    def ingest(self):
+        with self.ingest_lock:
+            log_files_data, self.cached_data = self.cached_data, []
+            started = time.perf_counter()
+            ranges = self.tailer.read_new_ranges()
+            # idle polls are not worth a sample
+            if ranges:
+                write_sample("data.parse", (time.perf_counter() - started) * 1000, note=f"rows={sum(len(df) for _, _, df, _ in ranges)}")
+            for log_file, start, df, offset in ranges:
+                self.cache.add(log_file, start, df, offset)
+                if not df.empty:
+                    log_files_data.append(df)
+            # the first ingest writes everything so the next start is fast
+            self.cache.flush(force=self.current.version == 0)
+            return self.apply(log_files_data)
+
+    # fold typed log frames into the status and publish a new snapshot, also used by the network receiver
+    def apply(self, log_files_data):
+        with self.ingest_lock:
+            if not log_files_data:
+                return False
+
+            # forecasts are replaced before the snapshot, so panels keyed on its version never keep older ones
+            with timed("forecast.update"):
+                self.forecaster.update(log_files_data)
+                self.forecasts = self.forecaster.forecasts()
+            with timed("data.update_status"):
+                self.status = init_default_dict(log_files_data, self.status)
+                self.status = update_default_dict(log_files_data, self.status)
+                self.current = StatusSnapshot.from_status(self.current.version + 1, self.status)
+
+            for listener in self.listeners:
+                try:
+                    listener(log_files_data)
+                except Exception:
+                    logger.exception("status worker listener %r failed", listener)
+            return True
+
+
+# Tails perf_log_files/ and publishes rolling latency statistics per app function
+class PerfWorker(PollingWorker):
+    def __init__(self, folder_path, poll_seconds=poll_seconds):
+        super().__init__("perf-worker", LogTailer(folder_path, perf_column_names), poll_seconds)
+        self.stats = PerfStats()
+        self.current = PerfSnapshot(0, datetime.now(), {})
+        self.resume()
+
+    # Lines already merged into PERF_sketch by an earlier run are read into the in-memory
+    # statistics only, and tailing carries on after them. Without the checkpoints every
+    # line is read as new, and lines an earlier run saved are counted twice.
+    def resume(self):
+        try:
+            checkpoints = get_perf_checkpoints()
+        except Exception:
+            logger.exception("perf worker could not load its checkpoints, perf logs are read from the start")
+            return
+        saved = []
+        for log_file, inode, offset, head, df in read_saved_ranges(checkpoints):
+            self.tailer.files[log_file] = {"inode": inode, "offset": offset, "size": 0, "head": head}
+            saved.append(df)
+        self.stats.update(get_perf_data(saved), save=False)
+
+    def ingest(self):
+        with self.ingest_lock:
+            return self.apply(self.tailer.read_new_logs())
+
+    # perf frames as read from perf_log_files/, also used by the network receiver
+    def apply(self, perf_files_data):
+        with self.ingest_lock:
+            perf_data = get_perf_data(perf_files_data)
+            if not perf_data:
+                return False
+            self.stats.update(perf_data)
+            self.current = PerfSnapshot(self.current.version + 1, datetime.now(), self.stats.summary())
+
+            rows = self.stats.pop_unsaved_sketches()
+            checkpoints = [(log_file, state["inode"], state["offset"], state["head"]) for log_file, state in self.tailer.files.items()]
+            try:
+                save_sketches(rows, checkpoints)
+            except Exception:
+                # keep them for the next ingest rather than lose the samples
+                self.stats.restore_unsaved(rows)
+                logger.exception("perf worker failed to save %d latency sketches", len(rows))
+            return True
+
+
+# Copies the lines appended to log_files/ into HEAL_archive and folds them into the
+# rollups, so the panels' queries see them without an external archive.py. Woken by the
+# status worker after each ingest. The writer resumes from its committed checkpoints,
+# and a lost connection is opened again on the next pass.
+class ArchiveWorker(PollingWorker):
+    def __init__(self, folder_path, poll_seconds=poll_seconds):
+        # the tailer only names the folder, the writer tails it from its own checkpoints
+        super().__init__("archive-worker", LogTailer(folder_path), poll_seconds)
+        self.writer = None
+
+    def ingest(self):
+        with self.ingest_lock:
+            if self.writer is None:
+                self.writer = ArchiveWriter(connect("executemany"), self.tailer.folder_path)
+            try:
+                archived, _, _ = self.writer.archive_new_logs()
+                # also without new rows, the rows of earlier passes settle for the rollups
+                run_rollup(self.writer.connection)
+            except mariadb.Error:
+                self.close()
+                raise
+            return archived > 0
+
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.connection.close()
+            except mariadb.Error:
+                pass
+            self.writer = None
+
+
+@st.cache_resource
+def get_archive_worker(folder_path=folder_path):
+    if not archive_enabled:
+        return None
+    worker = ArchiveWorker(folder_path)
+    worker.start()
+    return worker
+
+
+# one worker per process, started on first use and reused by every session and rerun
+@st.cache_resource
+def get_status_worker(folder_path=folder_path):
+    worker = StatusWorker(folder_path)
+    archive_worker = get_archive_worker(folder_path)
+    if archive_worker is not None:
+        # parsed lines are archived right after, the archive worker drops the query cache once they commit
+        worker.add_listener(lambda log_files_data: archive_worker.wake())
+    worker.ingest()
+    worker.start()
+    worker.watch()
+    return worker
+
+
+@st.cache_resource
+def get_perf_worker(folder_path=perf_folder_path):
+    worker = PerfWorker(folder_path)
+    worker.ingest()
+    worker.start()
+    worker.watch()
+    return worker
+
+
+# Lines sent by agents over the network go through the same workers as the log folders,
+# and their HEAL rows are archived as they arrive. Only started when HEAL_RECEIVER_PORT is set.
+@st.cache_resource
+def get_receiver():
+    if not receiver_enabled:
+        return None
+    status_worker, perf_worker = get_status_worker(), get_perf_worker()
+    archiver = BatchArchiver()
+
+    def on_heal(df):
+        status_worker.apply([typed_log_frame(df)])
+        archiver.archive(df)
+
+    try:
+        return LogReceiver(on_heal, lambda df: perf_worker.apply([df])).start()
+    except (OSError, TimeoutError):
+        # the dashboard still shows the log folders, e.g. while another process holds the port
+        logger.exception("log receiver could not listen, lines sent by agents are not received")
+        return None